@@ -0,0 +1,99 @@
+"""
+Бенчмарк Text2ImageAPI против локальной заглушки FusionBrain.
+
+Сравнивает задержку одного изображения в «холодном» режиме (новая сессия и
+запрос списка моделей на каждое изображение, как было раньше) и в «тёплом»
+(общая сессия с пулом соединений и закэшированный id модели).
+
+Запуск: python benchmarks/bench_kandinsky.py --images 200
+"""
+import argparse
+import asyncio
+import base64
+import os
+import statistics
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_gen_kandinsky
+from image_gen_kandinsky import Text2ImageAPI
+
+# Заглушка отвечает сразу: меряем накладные расходы HTTP, а не интервал опроса
+image_gen_kandinsky.POLL_INITIAL_DELAY = 0.0
+
+IMAGE_BASE64 = base64.b64encode(os.urandom(64 * 1024)).decode()
+
+
+def make_stub_app(generation_time: float = 0.0) -> web.Application:
+    """Заглушка FusionBrain: генерация завершается через generation_time секунд."""
+    started = {}
+
+    async def models(request):
+        return web.json_response([{"id": 4, "name": "Kandinsky", "version": 3.1, "type": "TEXT2IMAGE"}])
+
+    async def run(request):
+        await request.post()
+        uuid = str(uuid4())
+        started[uuid] = time.monotonic()
+        return web.json_response({"uuid": uuid, "status": "INITIAL"})
+
+    async def status(request):
+        uuid = request.match_info["uuid"]
+        if time.monotonic() - started.get(uuid, 0.0) < generation_time:
+            return web.json_response({"uuid": uuid, "status": "PROCESSING"})
+        started.pop(uuid, None)
+        return web.json_response({"uuid": uuid, "status": "DONE", "images": [IMAGE_BASE64]})
+
+    app = web.Application()
+    app.router.add_get("/key/api/v1/models", models)
+    app.router.add_post("/key/api/v1/text2image/run", run)
+    app.router.add_get("/key/api/v1/text2image/status/{uuid}", status)
+    return app
+
+
+async def measure(api: Text2ImageAPI, images: int, cold: bool) -> list:
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(images):
+            if cold:
+                await api.close()
+                api._model_id = None
+            started = time.perf_counter()
+            await api.generate_image("Лиса", 2, "1024x1024", os.path.join(tmp, f"{i}.png"))
+            latencies.append(time.perf_counter() - started)
+    await api.close()
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name}: p50 {p50:.2f} мс, p99 {p99:.2f} мс")
+
+
+async def main(images: int):
+    runner = web.AppRunner(make_stub_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/"
+    try:
+        report("До (новая сессия на запрос)", await measure(Text2ImageAPI(url, "key", "secret"), images, cold=True))
+        report("После (общая сессия)", await measure(Text2ImageAPI(url, "key", "secret"), images, cold=False))
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.images))
@@ -0,0 +1,121 @@
+"""
+Бенчмарк холодного старта: время от запуска процесса до обработки первого обновления.
+
+Каждый замер — новый процесс Python, который импортирует main, выполняет on_startup
+и пропускает через диспетчер команду /start; Bot API заменён локальной заглушкой.
+Базовая линия — процесс, который только импортирует aiogram и aiohttp: их время от бота
+не зависит и сильно меняется от машины к машине. Цель --target проверяется для разницы
+медиан, то есть для того, что добавляет сам бот; при превышении код возврата 1.
+
+Запуск: python benchmarks/bench_startup.py --runs 5 --target 1.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("METRICS_PORT", "0")
+
+
+async def child(api_url: str):
+    """Один холодный старт внутри отдельного процесса."""
+    started = time.perf_counter()
+    os.environ["BOT_TOKEN"] = "123456:benchmark"
+    os.environ["TELEGRAM_API_SERVER"] = api_url
+
+    import main
+    from aiogram.types import Update
+
+    imported = time.perf_counter()
+    await main.on_startup()
+    ready = time.perf_counter()
+    update = Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "user"},
+            "text": "/start",
+        },
+    }, context={"bot": main.bot})
+    await main.dp.feed_update(main.bot, update)
+    handled = time.perf_counter()
+    await main.on_shutdown()
+    await main.bot.session.close()
+    print(json.dumps({"import": imported - started, "startup": ready - imported, "first_update": handled - ready}))
+
+
+def baseline():
+    """Импорт фреймворков, без которых бот не запускается."""
+    started = time.perf_counter()
+    import aiohttp
+    import aiogram
+    import aiogram.types
+
+    print(json.dumps({"import": time.perf_counter() - started}))
+
+
+async def run_child(args: list, cwd: str) -> dict:
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), *args,
+        cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+    )
+    output, _ = await process.communicate()
+    total = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError(f"процесс бота завершился с кодом {process.returncode}")
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result["total"] = total
+    return result
+
+
+async def measure(runs: int) -> tuple:
+    from harness import make_bot_api_app, start_server
+
+    runner, api_url = await start_server(make_bot_api_app({}))
+    results, baselines = [], []
+    try:
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as tmp:
+                baselines.append(await run_child(["--baseline"], tmp))
+                results.append(await run_child(["--child", api_url], tmp))
+    finally:
+        await runner.cleanup()
+    return results, baselines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", type=float, default=1.5,
+                        help="сколько секунд бот может добавлять к базовой линии до первого обновления")
+    parser.add_argument("--child", metavar="API_URL", help=argparse.SUPPRESS)
+    parser.add_argument("--baseline", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.baseline:
+        baseline()
+        sys.exit(0)
+    if args.child:
+        asyncio.run(child(args.child))
+        sys.exit(0)
+
+    results, baselines = asyncio.run(measure(args.runs))
+    for phase in ("import", "startup", "first_update", "total"):
+        values = [result[phase] for result in results]
+        print(f"{phase:>12}: median {statistics.median(values) * 1000:8.1f} ms, max {max(values) * 1000:8.1f} ms")
+    median_baseline = statistics.median(result["total"] for result in baselines)
+    print(f"{'baseline':>12}: median {median_baseline * 1000:8.1f} ms (aiogram + aiohttp)")
+    overhead = statistics.median(result["total"] for result in results) - median_baseline
+    if overhead > args.target:
+        print(f"❌ Бот добавляет {overhead:.2f} с до первого обновления, цель {args.target} с")
+        sys.exit(1)
+    print(f"✅ Бот добавляет {overhead:.2f} с до первого обновления (цель {args.target} с)")
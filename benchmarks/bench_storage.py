@@ -0,0 +1,50 @@
+"""
+Бенчмарк хранилища: сколько сообщений в секунду выдерживает SQLiteStorage
+при одновременной работе множества пользователей.
+
+Запуск: python benchmarks/bench_storage.py --users 1000 --messages 10
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import SQLiteStorage
+
+
+async def simulate_user(storage: SQLiteStorage, user_id: int, messages: int):
+    """Повторяет путь обычного текстового сообщения: модель, история, две записи."""
+    for i in range(messages):
+        await storage.get_user_model(user_id)
+        await storage.get_chat_history(user_id, limit=10)
+        await storage.save_message(user_id, "user", f"Вопрос {i}")
+        await storage.save_message(user_id, "bot", f"Ответ {i} " * 20)
+
+
+async def run(users: int, messages: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(os.path.join(tmp, 'bench.db'))
+        await storage.open()
+        for user_id in range(users):
+            await storage.set_user_model(user_id, "gpt-4o")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate_user(storage, user_id, messages) for user_id in range(users)))
+        elapsed = time.perf_counter() - started
+        await storage.close()
+
+    total = users * messages
+    print(f"Пользователей: {users}, сообщений: {total}")
+    print(f"Время: {elapsed:.2f} с, {total / elapsed:.0f} сообщений/с")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.messages))
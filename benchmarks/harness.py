@@ -0,0 +1,295 @@
+"""
+Офлайн-бенчмарк бота целиком: g4f, Bot API и FusionBrain заменены локальными заглушками.
+
+Обновления от тысяч симулированных пользователей подаются в диспетчер aiogram,
+поэтому работают те же middleware, FSM, handle_user_message и prompt_choice_handler,
+что и в проде. В конце печатается и сохраняется в JSON сводка: сообщений в секунду,
+хвосты задержек, задержка event loop и память.
+
+Запуск: python benchmarks/harness.py --users 2000 --messages 3 --image-users 100 --output bench.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Читается при импорте metrics, то есть уже в bench_kandinsky
+os.environ.setdefault("METRICS_PORT", "0")
+
+from bench_kandinsky import make_stub_app as make_fusionbrain_app
+
+_message_ids = itertools.count(1)
+_update_ids = itertools.count(1)
+
+
+# --- Заглушка Bot API ---
+
+def make_bot_api_app(stats: dict) -> web.Application:
+    """Отвечает на методы Bot API так, как это сделал бы Telegram."""
+    async def handle(request):
+        method = request.match_info["method"]
+        stats[method] = stats.get(method, 0) + 1
+        data = await request.post()
+        if "⚠️" in data.get("text", ""):
+            # Пользователю ушло сообщение об ошибке: бенчмарк не должен молча мерить сломанный путь
+            stats["error_messages"] = stats.get("error_messages", 0) + 1
+        chat_id = int(data.get("chat_id", 0) or 0)
+        if method in ("sendMessage", "sendPhoto", "editMessageText"):
+            message_id = int(data.get("message_id", 0) or 0) or next(_message_ids)
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }
+        elif method == "sendMediaGroup":
+            result = []
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+async def start_server(app: web.Application) -> tuple:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+# --- Заглушка g4f ---
+
+class FakeProvider:
+    __name__ = "FakeProvider"
+
+
+def install_fake_g4f(tokens: int, tokens_per_second: float, first_token_delay: float, image_time: float):
+    """Подменяет потоковую генерацию g4f, перевод промта и генерацию изображений g4f."""
+    import g4f
+    import providers
+
+    async def create_async(model, messages, provider=None, stream=False, **kwargs):
+        await asyncio.sleep(first_token_delay)
+        for i in range(tokens):
+            yield f"токен{i} "
+            await asyncio.sleep(1 / tokens_per_second)
+
+    async def create_prompt_completion(**kwargs):
+        await asyncio.sleep(first_token_delay)
+        message = type("message", (), {"content": "A detailed picture of a fox"})
+        return type("response", (), {"choices": [type("choice", (), {"message": message})]})
+
+    async def generate_image(**kwargs):
+        await asyncio.sleep(image_time)
+        image = type("image", (), {"url": "https://example.com/image.png"})
+        return type("response", (), {"data": [image]})
+
+    g4f.ChatCompletion.create_async = create_async
+    providers.DEFAULT_PROVIDERS[:] = [FakeProvider]
+    providers.get_g4f_client().chat.completions.create = create_prompt_completion
+    providers.get_g4f_client().images.generate = generate_image
+
+
+# --- Симуляция пользователей ---
+
+def make_message_update(user_id: int, text: str) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def make_callback_update(user_id: int, data: str) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "chat_instance": str(user_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "data": data,
+            "message": {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+                "text": "Как сгенерировать промт для изображения?",
+            },
+        },
+    }
+
+
+async def feed(main, raw: dict, latencies: list):
+    from aiogram.types import Update
+
+    update = Update.model_validate(raw, context={"bot": main.bot})
+    started = time.perf_counter()
+    await main.dp.feed_update(main.bot, update)
+    latencies.append(time.perf_counter() - started)
+
+
+async def text_user(main, user_id: int, messages: int, latencies: list):
+    for i in range(messages):
+        await feed(main, make_message_update(user_id, f"Вопрос {i} от {user_id}"), latencies)
+
+
+async def image_user(main, user_id: int, variants: int, latencies: list):
+    await feed(main, make_message_update(user_id, "Рыжая лиса в лесу"), [])
+    if variants > 1:
+        await feed(main, make_callback_update(user_id, f"variants_{variants}"), [])
+    await feed(main, make_callback_update(user_id, "prompt_user"), latencies)
+
+
+async def measure_loop_lag(samples: list, interval: float = 0.01):
+    """Насколько позже запланированного просыпается event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(statistics.median(values) * 1000, 2) if values else 0.0,
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return ""
+
+
+async def run(args) -> dict:
+    bot_api_stats = {}
+    bot_api_runner, bot_api_url = await start_server(make_bot_api_app(bot_api_stats))
+    fusionbrain_runner, fusionbrain_url = await start_server(make_fusionbrain_app(args.image_time))
+
+    os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+    os.environ["TELEGRAM_API_SERVER"] = bot_api_url
+    tmp = tempfile.TemporaryDirectory()
+    os.chdir(tmp.name)
+
+    import main
+    import telegram_edits
+
+    # Строка лога на каждое обновление сама по себе заметно нагружает event loop
+    logging.getLogger().setLevel(args.log_level)
+
+    install_fake_g4f(args.tokens, args.tokens_per_second, args.first_token_delay, args.image_time)
+    main.TEXT2IMAGE_API_URL = fusionbrain_url + "/"
+    main.db.backend.path = os.path.join(tmp.name, "bench.db")
+    telegram_edits.edit_scheduler._global.rate = args.edit_rate
+    telegram_edits.edit_scheduler._global.capacity = args.edit_rate
+    telegram_edits.edit_scheduler.chat_rate = args.edit_rate
+
+    await main.on_startup()
+    text_users = range(1, args.users + 1)
+    image_users = range(args.users + 1, args.users + args.image_users + 1)
+    # Часть пользователей изображений работает через g4f (Flux), остальные через Kandinsky
+    flux_users = set(image_users[:round(len(image_users) * args.flux_share)])
+    for user_id in text_users:
+        await main.set_user_model(user_id, "gpt-4o")
+    for user_id in image_users:
+        await main.set_user_model(user_id, "flux" if user_id in flux_users else "kandinsky")
+
+    text_latencies, flux_latencies, kandinsky_latencies, lag = [], [], [], []
+    lag_task = asyncio.create_task(measure_loop_lag(lag))
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(text_user(main, user_id, args.messages, text_latencies) for user_id in text_users),
+        *(image_user(main, user_id, args.variants, flux_latencies if user_id in flux_users else kandinsky_latencies)
+          for user_id in image_users),
+    )
+    elapsed = time.perf_counter() - started
+    peak_traced = 0
+    if args.tracemalloc:
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    lag_task.cancel()
+
+    await main.on_shutdown()
+    await main.bot.session.close()
+    await bot_api_runner.cleanup()
+    await fusionbrain_runner.cleanup()
+    os.chdir(ROOT)
+    tmp.cleanup()
+
+    return {
+        "revision": git_revision(),
+        "config": vars(args),
+        "elapsed_s": round(elapsed, 2),
+        "messages_per_second": round(len(text_latencies) / elapsed, 1),
+        "images_per_second": round((len(flux_latencies) + len(kandinsky_latencies)) / elapsed, 2),
+        "text_latency": summarize(text_latencies),
+        "flux_latency": summarize(flux_latencies),
+        "kandinsky_latency": summarize(kandinsky_latencies),
+        "loop_lag": summarize(lag),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_traced_memory_mb": round(peak_traced / 1024 / 1024, 1),
+        "bot_api_calls": bot_api_stats,
+        "edits": telegram_edits.edit_scheduler.stats(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000, help="пользователи с текстовой моделью")
+    parser.add_argument("--messages", type=int, default=3, help="сообщений от каждого пользователя")
+    parser.add_argument("--image-users", type=int, default=100, help="пользователи с моделями изображений")
+    parser.add_argument("--flux-share", type=float, default=0.5, help="доля пользователей изображений на Flux")
+    parser.add_argument("--tokens", type=int, default=50, help="токенов в ответе")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--variants", type=int, default=1, help="вариантов изображения на запрос")
+    parser.add_argument("--image-time", type=float, default=1.0, help="время генерации изображения")
+    parser.add_argument("--edit-rate", type=float, default=10000.0,
+                        help="лимит правок в секунду (реальный Telegram: около 25 на бота)")
+    parser.add_argument("--tracemalloc", action="store_true", help="считать пик памяти Python (медленнее)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default="", help="куда сохранить результат в JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,81 @@
+"""
+Нагрузочный тест webhook: отправляет синтетические обновления на локальный экземпляр
+бота и выводит p50/p99 задержки обработчика.
+
+Экземпляр стоит запустить с WEBHOOK_HANDLE_IN_BACKGROUND=0, чтобы время ответа на
+HTTP-запрос включало работу обработчика, и с TELEGRAM_API_SERVER, указывающим на
+заглушку Bot API, чтобы ответы бота не уходили в настоящий Telegram.
+
+Запуск: python benchmarks/loadtest_webhook.py --url http://127.0.0.1:8080/webhook --updates 5000
+"""
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+
+import aiohttp
+
+_update_ids = itertools.count(1)
+
+
+def make_update(user_id: int, text: str) -> dict:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def run(url: str, secret: str, updates: int, concurrency: int, users: int, text: str):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def send(i: int):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, json=make_update(i % users + 1, text)) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                            return
+                except aiohttp.ClientError:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(updates)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    if latencies:
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+        print(f"Обновлений: {len(latencies)}, ошибок: {errors}, {len(latencies) / elapsed:.0f} обновлений/с")
+        print(f"Задержка обработчика: p50 {p50:.1f} мс, p99 {p99:.1f} мс")
+    else:
+        print(f"Все {errors} запросов завершились ошибкой")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--text", default="/help")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.secret, args.updates, args.concurrency, args.users, args.text))
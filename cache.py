@@ -0,0 +1,144 @@
+import time
+from collections import OrderedDict
+
+from storage import BaseStorage
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Словарь с ограничением по размеру (LRU) и времени жизни записей."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        value = self.peek(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Как get, но не учитывается в счётчиках и не меняет порядок вытеснения."""
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        expires, value = item
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class CachedStorage(BaseStorage):
+    """
+    Write-through кэш поверх другого хранилища.
+
+    Держит в памяти модель пользователя и последние history_limit сообщений его истории,
+    поэтому для активных пользователей обычное сообщение не обращается к базе.
+    """
+
+    def __init__(self, backend: BaseStorage, maxsize: int = 10000, ttl: float = 600, history_limit: int = 10):
+        self.backend = backend
+        self.history_limit = history_limit
+        self.models = LRUCache(maxsize, ttl)
+        # user_id -> (строки истории, True если в памяти вся история пользователя)
+        self.history = LRUCache(maxsize, ttl)
+        # Номер версии истории пользователя: защищает кэш от записи устаревшего результата чтения
+        self._versions = {}
+
+    async def open(self):
+        await self.backend.open()
+
+    async def close(self):
+        await self.backend.close()
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов кэша."""
+        return {
+            "model_hits": self.models.hits,
+            "model_misses": self.models.misses,
+            "history_hits": self.history.hits,
+            "history_misses": self.history.misses,
+        }
+
+    def _bump(self, user_id: int):
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        if len(self._versions) > self.history.maxsize * 2:
+            self._versions.clear()
+
+    async def get_user_model(self, user_id: int) -> str:
+        model = self.models.get(user_id)
+        if model is None:
+            model = await self.backend.get_user_model(user_id)
+            self.models.set(user_id, model)
+        return model
+
+    async def set_user_model(self, user_id: int, model: str):
+        await self.backend.set_user_model(user_id, model)
+        self.models.set(user_id, model)
+
+    async def save_message(self, user_id: int, message_type: str, content: str):
+        await self.backend.save_message(user_id, message_type, content)
+        self._bump(user_id)
+        entry = self.history.peek(user_id)
+        if entry is None:
+            return
+        rows, complete = entry
+        rows = rows + [(message_type, content)]
+        if len(rows) > self.history_limit:
+            rows = rows[-self.history_limit:]
+            complete = False
+        self.history.set(user_id, (rows, complete))
+
+    async def get_chat_history(self, user_id: int, limit: int = 10) -> list:
+        entry = self.history.get(user_id)
+        if entry is not None:
+            rows, complete = entry
+            if complete or limit <= len(rows):
+                return rows[-limit:] if limit else []
+        version = self._versions.get(user_id)
+        fetch_limit = max(limit, self.history_limit)
+        rows = await self.backend.get_chat_history(user_id, fetch_limit)
+        if self._versions.get(user_id) == version:
+            complete = len(rows) < fetch_limit and len(rows) <= self.history_limit
+            self.history.set(user_id, (rows[-self.history_limit:], complete))
+        return rows[-limit:] if limit else []
+
+    async def clear_chat_history(self, user_id: int):
+        await self.backend.clear_chat_history(user_id)
+        self._bump(user_id)
+        self.history.set(user_id, ([], True))
+
+    async def compact(self) -> int:
+        deleted = await self.backend.compact()
+        if deleted:
+            self.history.clear()
+        return deleted
@@ -0,0 +1,80 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = "Ты отвечаешь в телеграмме, используй форматирование как в телеграмме"
+
+# Сколько токенов контекста отправлять каждой модели (системный промт, история и вопрос)
+DEFAULT_TOKEN_BUDGET = 3000
+MODEL_TOKEN_BUDGETS = {
+    "gpt-4o": 6000,
+    "gpt-4o-mini": 6000,
+    "gpt-4.1": 6000,
+    "deepseek-v3": 4000,
+    "deepseek-r1": 4000,
+    "llama-3.3-70b": 3000,
+}
+# Служебные токены, которые добавляет каждое сообщение чата
+MESSAGE_OVERHEAD = 4
+# Сколько токенов можно потратить на краткое содержание отброшенной части диалога
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_LINE_CHARS = 160
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: около четырёх байт UTF-8 на токен."""
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def _summarize(dropped: list, budget: int) -> str:
+    """Короткая выжимка отброшенных реплик: начало каждой, пока хватает бюджета."""
+    lines = []
+    used = 0
+    for msg_type, content in reversed(dropped):
+        speaker = "Пользователь" if msg_type == "user" else "Бот"
+        text = " ".join(content.split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS].rsplit(" ", 1)[0] + "…"
+        line = f"{speaker}: {text}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(reversed(lines))
+
+
+def build_messages(model: str, history: list, user_message: str):
+    """
+    Собирает контекст запроса в пределах бюджета токенов модели.
+
+    Новые реплики истории берутся целиком, пока помещаются; более старые заменяются
+    краткой выжимкой или отбрасываются. Возвращает сообщения и оценку отправленных токенов.
+    """
+    budget = MODEL_TOKEN_BUDGETS.get(model.lower(), DEFAULT_TOKEN_BUDGET)
+    used = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(user_message) + 2 * MESSAGE_OVERHEAD
+
+    kept = []
+    for msg_type, content in reversed(history):
+        cost = estimate_tokens(content) + MESSAGE_OVERHEAD
+        if used + cost > budget:
+            break
+        kept.append((msg_type, content))
+        used += cost
+    kept.reverse()
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    dropped = history[:len(history) - len(kept)]
+    if dropped:
+        summary = _summarize(dropped, min(SUMMARY_MAX_TOKENS, budget - used - MESSAGE_OVERHEAD))
+        if summary:
+            content = f"Краткое содержание начала диалога:\n{summary}"
+            messages.append({"role": "system", "content": content})
+            used += estimate_tokens(content) + MESSAGE_OVERHEAD
+    for msg_type, content in kept:
+        role = "user" if msg_type == "user" else "assistant"
+        messages.append({"role": role, "content": content})
+    messages.append({"role": "user", "content": user_message})
+
+    logger.info(f"📨 {model}: ~{used} токенов контекста, история {len(kept)}/{len(history)}")
+    return messages, used
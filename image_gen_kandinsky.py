@@ -1,23 +1,190 @@
 import aiohttp
 import asyncio
-import base64
+import binascii
 import json
+import logging
+import random
+import time
+from metrics import IMAGE_POLL_SECONDS, IMAGE_POLL_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд считать закэшированный id модели актуальным
+MODEL_ID_TTL = 3600
+
+# Опрос статуса: первая проверка быстро, затем интервал растёт экспоненциально со случайным разбросом
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 10.0
+POLL_BACKOFF = 1.6
+POLL_JITTER = 0.2
+POLL_TIMEOUT = 120.0
+# Ограничения на HTTP-запросы к FusionBrain (по умолчанию aiohttp ждёт до 300 секунд);
+# статус запрашивается часто, поэтому его ждём меньше
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10)
+STATUS_TIMEOUT = aiohttp.ClientTimeout(total=20, connect=5)
+
+
+def decode_image(image_base64: str) -> bytes:
+    """
+    Декодирует base64 одним вызовом: символы вне алфавита (переводы строк, пробелы)
+    пропускаются, а в памяти нет промежуточных кусков, кроме входной строки и результата.
+    """
+    return binascii.a2b_base64(image_base64)
+
+
+def _write_file(file_path, data: bytes):
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+
+class GenerationTimeoutError(Exception):
+    """Генерация не завершилась за отведённое время."""
+
+
+class _PollJob:
+    def __init__(self, uuid, timeout):
+        now = time.monotonic()
+        self.uuid = uuid
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+        self.delay = POLL_INITIAL_DELAY
+        self.next_check = now + POLL_INITIAL_DELAY
+        self.deadline = now + timeout
+        self.created = now
+        # Задача текущей проверки статуса, пока она идёт
+        self.check = None
+
+
+class GenerationPoller:
+    """
+    Одна фоновая задача, которая опрашивает статусы всех генераций в работе.
+
+    Каждый вызов wait() получает future, который разрешается, когда генерация готова.
+    Проверка каждого UUID идёт отдельной задачей и сама назначает следующую,
+    поэтому зависший запрос статуса не задерживает остальные генерации.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self._jobs = {}
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    def pending(self) -> int:
+        return len(self._jobs)
+
+    async def wait(self, uuid, timeout=POLL_TIMEOUT):
+        """Ждёт завершения генерации и возвращает список изображений в base64."""
+        job = self._jobs.get(uuid)
+        if job is None:
+            job = self._jobs[uuid] = _PollJob(uuid, timeout)
+            self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+        finally:
+            job.waiters -= 1
+            if job.waiters == 0 and not job.future.done():
+                # Результат больше никому не нужен
+                job.future.cancel()
+                self._jobs.pop(uuid, None)
+
+    async def _run(self):
+        while self._jobs:
+            now = time.monotonic()
+            for job in list(self._jobs.values()):
+                if job.check is None and job.next_check <= now:
+                    job.check = asyncio.create_task(self._check(job))
+                    job.check.add_done_callback(lambda _, job=job: self._checked(job))
+            # Пока все проверки в полёте, ждём, когда какая-нибудь из них закончится
+            idle = [job.next_check for job in self._jobs.values() if job.check is None]
+            timeout = max(0.0, min(idle) - time.monotonic()) if idle else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _checked(self, job):
+        job.check = None
+        self._wakeup.set()
+
+    def _resolve(self, job, result=None, error=None):
+        self._jobs.pop(job.uuid, None)
+        IMAGE_POLL_SECONDS.observe(time.monotonic() - job.created)
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    async def _check(self, job):
+        status, images, retry_after = None, None, None
+        try:
+            status, images, retry_after = await self.api._fetch_status(job.uuid)
+            IMAGE_POLL_REQUESTS.inc(status=status)
+        except Exception as e:
+            IMAGE_POLL_REQUESTS.inc(status="ERROR")
+            logger.warning(f"⚠️ Ошибка проверки статуса {job.uuid}: {str(e)}")
+
+        now = time.monotonic()
+        if status == 'DONE':
+            self._resolve(job, images)
+        elif status == 'FAIL':
+            logger.error(f"❌ Генерация {job.uuid} завершилась ошибкой")
+            self._resolve(job, None)
+        elif now >= job.deadline:
+            self._resolve(job, error=GenerationTimeoutError(f"Генерация {job.uuid} не завершилась вовремя"))
+        else:
+            delay = job.delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            if retry_after:
+                # Сервер сам подсказал, когда спрашивать снова
+                delay = max(delay, retry_after)
+            job.next_check = min(now + delay, job.deadline)
+            job.delay = min(job.delay * POLL_BACKOFF, POLL_MAX_DELAY)
 
 
 class Text2ImageAPI:
-    def __init__(self, url, api_key, secret_key):
+    def __init__(self, url, api_key, secret_key, pool_size=100):
         self.URL = url
         self.AUTH_HEADERS = {
             'X-Key': f'Key {api_key}',
             'X-Secret': f'Secret {secret_key}',
         }
         self.STYLES = ["KANDINSKY", "UHD", "ANIME", "DEFAULT"]
+        self.pool_size = pool_size
+        self._session = None
+        self._model_id = None
+        self._model_id_expires = 0.0
+        self._model_lock = asyncio.Lock()
+        self.poller = GenerationPoller(self)
+
+    def _get_session(self):
+        """Возвращает общую сессию с пулом keep-alive соединений, создавая её при первом обращении."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.AUTH_HEADERS, timeout=HTTP_TIMEOUT)
+        return self._session
 
-    async def _get_model_id(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.URL + 'key/api/v1/models', headers=self.AUTH_HEADERS) as response:
+    async def close(self):
+        """Закрывает сессию и её пул соединений."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_model_id(self, refresh=False):
+        async with self._model_lock:
+            if not refresh and self._model_id is not None and time.monotonic() < self._model_id_expires:
+                return self._model_id
+            session = self._get_session()
+            async with session.get(self.URL + 'key/api/v1/models') as response:
                 data = await response.json()
-                return data[0]['id']
+            self._model_id = data[0]['id']
+            self._model_id_expires = time.monotonic() + MODEL_ID_TTL
+            return self._model_id
 
     async def _generate(self, prompt, model, style, dimensions):
         style_name = self.STYLES[style]
@@ -34,7 +201,7 @@ class Text2ImageAPI:
         if dimensions in mod_options:
             width, height, doptext = mod_options[dimensions]
 
-        print(width, height, doptext, prompt)
+        logger.debug(f"Генерация {width}x{height} ({doptext}): {prompt}")
         params = {
             "type": "GENERATE",
             "numImages": 1,
@@ -50,48 +217,67 @@ class Text2ImageAPI:
         data.add_field('model_id', str(model))
         data.add_field('params', json.dumps(params), content_type='application/json')
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    self.URL + 'key/api/v1/text2image/run',
-                    headers=self.AUTH_HEADERS,
-                    data=data
-            ) as response:
-                result = await response.json()
-                print("Response from _generate:", result)
-                return result.get('uuid')
-
-    async def _check_generation(self, request_id):
+        session = self._get_session()
+        async with session.post(self.URL + 'key/api/v1/text2image/run', data=data) as response:
+            result = await response.json(content_type=None)
+            logger.debug(f"Ответ _generate: {result}")
+            return result.get('uuid') if isinstance(result, dict) else None
+
+    async def _fetch_status(self, request_id):
+        """Один запрос статуса: (status, images, подсказанная сервером задержка)."""
+        session = self._get_session()
+        url = self.URL + 'key/api/v1/text2image/status/' + request_id
+        async with session.get(url, timeout=STATUS_TIMEOUT) as response:
+            retry_after = response.headers.get('Retry-After')
+            data = await response.json(content_type=None)
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        return data.get('status'), data.get('images'), retry_after
+
+    async def _check_generation(self, request_id, timeout=POLL_TIMEOUT):
         if request_id is None:
-            print("Ошибка: request_id отсутствует")
+            logger.error("❌ Ошибка: request_id отсутствует")
             return None
+        return await self.poller.wait(request_id, timeout)
 
-        attempts = 10
-        delay = 10
-        async with aiohttp.ClientSession() as session:
-            while attempts > 0:
-                async with session.get(self.URL + 'key/api/v1/text2image/status/' + request_id,
-                                    headers=self.AUTH_HEADERS) as response:
-                    data = await response.json()
-                    if data['status'] == 'DONE':
-                        return data['images']
-                    attempts -= 1
-                    await asyncio.sleep(delay)
-        return None
-
-    async def _save_image(self, image_base64, file_path):
-        image_data = base64.b64decode(image_base64)
-        with open(file_path, 'wb') as f:
-            f.write(image_data)
-
-    async def generate_image(self, prompt, style, dimensions, file_path):
+    async def submit(self, prompt, style, dimensions):
+        """Ставит генерацию в очередь FusionBrain и возвращает её id."""
         model_id = await self._get_model_id()
         uuid = await self._generate(prompt, model_id, style, dimensions)
-        images = await self._check_generation(uuid)
-        if images:
-            await self._save_image(images[0], file_path)
-        else:
-            print("Ошибка при генерации изображения.")
+        if uuid is None:
+            # API могло отклонить устаревший id модели: обновляем его и пробуем ещё раз
+            model_id = await self._get_model_id(refresh=True)
+            uuid = await self._generate(prompt, model_id, style, dimensions)
+        return uuid
+
+    async def generate_image_bytes(self, prompt, style, dimensions, on_submitted=None):
+        """
+        Генерирует изображение и возвращает его байты без записи на диск.
+        on_submitted(uuid) вызывается, как только FusionBrain принял задачу.
+        """
+        uuid = await self.submit(prompt, style, dimensions)
+        if uuid is not None and on_submitted is not None:
+            await on_submitted(uuid)
+        return await self.fetch_image_bytes(uuid)
+
+    async def fetch_image_bytes(self, uuid, timeout=POLL_TIMEOUT):
+        """Дожидается уже запущенной генерации и возвращает байты изображения."""
+        images = await self._check_generation(uuid, timeout)
+        if not images:
+            logger.error("❌ Ошибка при генерации изображения.")
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, decode_image, images[0])
+
+    async def generate_image(self, prompt, style, dimensions, file_path):
+        image_data = await self.generate_image_bytes(prompt, style, dimensions)
+        if image_data is None:
             return None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _write_file, file_path, image_data)
+        return file_path
 
 
 async def main():
@@ -107,4 +293,5 @@ async def main():
     file_path = "output_image.png"
 
     await text2image_api.generate_image(prompt, style, dimensions, file_path)
+    await text2image_api.close()
     print("ok")
@@ -1,20 +1,33 @@
 
+import asyncio
 import logging
-from aiogram.types import Message
-from g4f.client import Client
+from aiogram.types import Message, BufferedInputFile, InputMediaPhoto
+from image_gen_kandinsky import Text2ImageAPI, GenerationTimeoutError
+from response_cache import response_cache
+from metrics import IMAGE_GENERATION_SECONDS, span
+from journal import job_journal
+from providers import get_g4f_client
 
 logger = logging.getLogger(__name__)
-g4f_client = Client()
 
 BLACKBOX_LIMIT_MSG = "You have reached your request limit for the hour."
 
-def create_prompt(user_text: str) -> str:
+# Сколько изображений может генерироваться одновременно
+IMAGE_GENERATION_CONCURRENCY = 4
+image_semaphore = asyncio.Semaphore(IMAGE_GENERATION_CONCURRENCY)
+# Сколько вариантов изображения можно заказать одним запросом (не больше 10 — лимит медиагруппы)
+IMAGE_VARIANT_CHOICES = (1, 2, 4)
+
+async def create_prompt(user_text: str) -> str:
     """
     Создаёт промт для генерации изображения с помощью g4f.
     """
+    cache_key = response_cache.key("gpt-4:image-prompt", user_text)
+    cached = await response_cache.get(cache_key)
+    if cached:
+        return cached
     try:
-        client = Client()
-        response = client.chat.completions.create(
+        response = await get_g4f_client().chat.completions.create(
             model="gpt-4",
             messages=[{"role": "user", "content": f"Translate into English and create a detailed promt for image generation based on and send only promt: {user_text}"}],
         )
@@ -23,6 +36,7 @@ def create_prompt(user_text: str) -> str:
         if BLACKBOX_LIMIT_MSG in prompt_text:
             raise Exception("⚠️ Произошла ошибка при генерации изображения. Попробуйте снова.")
         # ---
+        await response_cache.set(cache_key, prompt_text)
         return prompt_text
     except Exception as e:
         logger.error(f"❌ Ошибка генерации промта с помощью g4f: {str(e)}")
@@ -32,17 +46,53 @@ def create_prompt(user_text: str) -> str:
         return f"Generate an image based on the following description: {user_text}"
 
 
-async def generate_image_with_flux_and_send(message: Message, translated_prompt: str, model: str):
+async def _generate_variants(generate, count: int):
+    """
+    Запускает count генераций одновременно (общий лимит держит image_semaphore).
+    Возвращает удачные результаты и ошибки остальных; пустой результат тоже считается ошибкой.
+    """
+    results = await asyncio.gather(*(generate() for _ in range(count)), return_exceptions=True)
+    images, errors = [], []
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error(f"❌ Ошибка генерации варианта изображения: {str(result)}")
+            errors.append(result)
+        elif result:
+            images.append(result)
+        else:
+            errors.append(None)
+    return images, errors
+
+
+async def _send_images(bot, chat_id: int, photos: list, requested: int):
+    """Одно изображение — фото, несколько — одна медиагруппа; сообщает, сколько вариантов не получилось."""
+    if len(photos) == 1:
+        await bot.send_photo(chat_id, photos[0])
+    else:
+        await bot.send_media_group(chat_id, [InputMediaPhoto(media=photo) for photo in photos])
+    if len(photos) < requested:
+        await bot.send_message(chat_id, f"⚠️ Получилось {len(photos)} из {requested} изображений.")
+
+
+def _as_photos(images: list) -> list:
+    return [BufferedInputFile(data, filename=f"image{i}.png") for i, data in enumerate(images, 1)]
+
+
+def _progress_text(variants: int) -> str:
+    return "⏳ Создание изображения..." if variants == 1 else f"⏳ Создание {variants} вариантов изображения..."
+
+
+async def generate_image_with_flux_and_send(message: Message, translated_prompt: str, model: str, variants: int = 1):
     """
     Генерация изображения с помощью Flux и отправка пользователю по URL.
     """
     generating_message = None
     
     try:
-        generating_message = await message.answer("⏳ Создание изображения...")
+        generating_message = await message.answer(_progress_text(variants))
         # Создание финального промта
         try:
-            final_prompt = create_prompt(translated_prompt)
+            final_prompt = await create_prompt(translated_prompt)
         except Exception as e:
             if BLACKBOX_LIMIT_MSG in str(e):
                 if generating_message:
@@ -52,17 +102,78 @@ async def generate_image_with_flux_and_send(message: Message, translated_prompt:
             else:
                 raise
         # Генерация изображения
-        response = g4f_client.images.generate(
-            model=model,
-            prompt=final_prompt,
-            response_format="url"
-        )
-        image_url = response.data[0].url  # Получаем URL изображения
+        async def generate():
+            async with image_semaphore:
+                with IMAGE_GENERATION_SECONDS.time(model=model), span("image", model=model):
+                    response = await get_g4f_client().images.generate(
+                        model=model,
+                        prompt=final_prompt,
+                        response_format="url"
+                    )
+            return response.data[0].url  # Получаем URL изображения
+
+        # Flux не даёт id задачи, поэтому после перезапуска пользователя можно только предупредить
+        async with job_journal.track("image", chat_id=message.chat.id):
+            image_urls, _ = await _generate_variants(generate, variants)
+            if generating_message:
+                await generating_message.delete()
+                generating_message = None
+            if not image_urls:
+                await message.answer("⚠️ Произошла ошибка при генерации изображения. Попробуйте снова.")
+                return
+            # Отправляем изображения пользователю
+            await _send_images(message.bot, message.chat.id, image_urls, variants)
+    except Exception as e:
+        logger.error(f"❌ Ошибка генерации изображения Flux: {str(e)}")
+        await message.answer("⚠️ Произошла ошибка при генерации изображения. Попробуйте снова.")
+
+
+async def generate_image_with_kandinsky_and_send(message: Message, api: Text2ImageAPI, user_text: str,
+                                                 auto_prompt: bool = True, style: int = 3,
+                                                 dimensions: str = "1024x1024", variants: int = 1):
+    """
+    Генерация изображения с помощью Kandinsky и отправка пользователю байтами, без записи на диск.
+    """
+    generating_message = None
+
+    try:
+        generating_message = await message.answer(_progress_text(variants))
+        prompt = await create_prompt(user_text) if auto_prompt else user_text
+
+        # id генераций пишутся в журнал: после перезапуска бота результат ещё можно забрать
+        async with job_journal.track("kandinsky", chat_id=message.chat.id, variants=variants) as job:
+            async def generate():
+                async with image_semaphore:
+                    with IMAGE_GENERATION_SECONDS.time(model="kandinsky"), span("image", model="kandinsky"):
+                        return await api.generate_image_bytes(
+                            prompt, style, dimensions, on_submitted=lambda uuid: job.append("uuids", uuid)
+                        )
+
+            images, errors = await _generate_variants(generate, variants)
+            if generating_message:
+                await generating_message.delete()
+                generating_message = None
+            if not images:
+                if errors and all(isinstance(error, GenerationTimeoutError) for error in errors):
+                    raise errors[0]
+                await message.answer("⚠️ Произошла ошибка при генерации изображения. Попробуйте снова.")
+                return
+            await _send_images(message.bot, message.chat.id, _as_photos(images), variants)
+    except GenerationTimeoutError:
+        logger.error("⌛ Превышено время ожидания генерации Kandinsky")
         if generating_message:
             await generating_message.delete()
-        # Отправляем изображение пользователю
-        await message.answer_photo(image_url)
+        await message.answer("⌛ Превышено время ожидания генерации изображения. Попробуйте снова.")
     except Exception as e:
-        logger.error(f"❌ Ошибка генерации изображения Flux: {str(e)}")
+        logger.error(f"❌ Ошибка генерации изображения Kandinsky: {str(e)}")
         await message.answer("⚠️ Произошла ошибка при генерации изображения. Попробуйте снова.")
 
+
+async def resume_kandinsky_job(bot, api: Text2ImageAPI, chat_id: int, uuids: list, variants: int):
+    """Забирает генерации, начатые до перезапуска бота, и отправляет их пользователю."""
+    results = await asyncio.gather(*(api.fetch_image_bytes(uuid) for uuid in uuids), return_exceptions=True)
+    images = [result for result in results if result and not isinstance(result, BaseException)]
+    if not images:
+        await bot.send_message(chat_id, "⚠️ Генерация изображения прервалась из-за перезапуска бота. Попробуйте снова.")
+        return
+    await _send_images(bot, chat_id, _as_photos(images), variants)
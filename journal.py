@@ -0,0 +1,223 @@
+"""
+Журнал начатых генераций, чтобы не терять их при перезапуске бота.
+
+Каждая запись — строка JSON в jobs.jsonl: начало задачи, id генерации FusionBrain,
+завершение. Записи копятся и сбрасываются на диск пачкой с одним fsync, а ожидающие
+корутины продолжают работу только после него. При старте незавершённые задачи
+загружаются из файла; фоновое сжатие переписывает файл без завершённых задач.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "jobs.jsonl")
+# Сколько секунд копить записи перед одним fsync
+JOURNAL_FLUSH_INTERVAL = 0.02
+# Как часто переписывать журнал без завершённых задач
+JOURNAL_COMPACT_INTERVAL = 600
+# Задачи старше этого не восстанавливаются: FusionBrain уже не отдаст результат
+JOB_MAX_AGE = 24 * 60 * 60
+
+
+class JournalJob:
+    """Незавершённая задача из журнала."""
+
+    def __init__(self, journal: "JobJournal", job_id: str):
+        self.journal = journal
+        self.id = job_id
+
+    async def append(self, field: str, value):
+        """Добавляет значение в списочное поле задачи, например id генерации."""
+        await self.journal._write({"op": "append", "id": self.id, "field": field, "value": value})
+
+
+class JobJournal:
+    def __init__(self, path: str = JOURNAL_PATH, flush_interval: float = JOURNAL_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-writer")
+        self._file = None
+        self._jobs = {}
+        self._finished = 0
+        self._pending = []
+        self._flush_handle = None
+
+    # --- Файл ---
+
+    def _load(self) -> dict:
+        jobs = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for number, line in enumerate(f, 1):
+                    try:
+                        self._apply(jobs, json.loads(line))
+                    except (ValueError, KeyError) as e:
+                        # Последняя строка могла оборваться при падении процесса
+                        logger.warning(f"⚠️ Пропущена строка {number} журнала {self.path}: {str(e)}")
+        self._file = open(self.path, "a", encoding="utf-8")
+        return jobs
+
+    @staticmethod
+    def _apply(jobs: dict, record: dict):
+        op = record["op"]
+        if op == "start":
+            jobs[record["id"]] = dict(record["job"])
+        elif op == "append":
+            job = jobs.get(record["id"])
+            if job is not None:
+                job.setdefault(record["field"], []).append(record["value"])
+        elif op == "done":
+            jobs.pop(record["id"], None)
+
+    def _write_batch(self, lines: list):
+        self._file.write("".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _rewrite(self, lines: list):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    async def open(self) -> dict:
+        """Открывает журнал и возвращает незавершённые задачи прошлого запуска: {id: поля задачи}."""
+        if self._file is None:
+            loop = asyncio.get_running_loop()
+            self._jobs = await loop.run_in_executor(self._executor, self._load)
+        return {job_id: dict(job) for job_id, job in self._jobs.items()}
+
+    async def close(self):
+        if self._file is None:
+            return
+        await self._flush()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._file.close)
+        self._file = None
+        self._executor.shutdown(wait=True)
+
+    # --- Пакетная запись ---
+
+    def _schedule_flush(self):
+        """Отправляет накопленные записи в поток-писатель, не дожидаясь результата."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return None
+        batch, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        write = loop.run_in_executor(self._executor, self._write_batch, [line for line, _ in batch])
+
+        def _resolve(task):
+            error = task.exception()
+            for _, waiter in batch:
+                if waiter is None or waiter.done():
+                    continue
+                if error:
+                    waiter.set_exception(error)
+                else:
+                    waiter.set_result(None)
+
+        write.add_done_callback(_resolve)
+        return write
+
+    async def _flush(self):
+        write = self._schedule_flush()
+        if write is not None:
+            await asyncio.shield(write)
+
+    async def _write(self, record: dict, durable: bool = True):
+        """Записывает строку журнала; с durable=True ждёт, пока она окажется на диске."""
+        if self._file is None:
+            return
+        self._apply(self._jobs, record)
+        if record["op"] == "done":
+            self._finished += 1
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future() if durable else None
+        self._pending.append((json.dumps(record, ensure_ascii=False) + "\n", waiter))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._schedule_flush)
+        if waiter is not None:
+            await waiter
+
+    # --- Задачи ---
+
+    async def start(self, kind: str, durable: bool = True, **fields) -> JournalJob:
+        job_id = uuid4().hex
+        record = {"op": "start", "id": job_id, "job": {"kind": kind, "created": time.time(), **fields}}
+        await self._write(record, durable)
+        return JournalJob(self, job_id)
+
+    async def finish(self, job_id: str, durable: bool = True):
+        await self._write({"op": "done", "id": job_id}, durable)
+
+    @asynccontextmanager
+    async def track(self, kind: str, durable: bool = True, **fields):
+        """
+        Отмечает задачу в журнале на время блока.
+
+        Ошибка тоже завершает задачу; отмена (остановка бота) оставляет её незавершённой,
+        чтобы при следующем запуске её можно было восстановить. С durable=False блок
+        не ждёт fsync: подходит для задач, которые после перезапуска нечем продолжить.
+        """
+        job = await self.start(kind, durable, **fields)
+        try:
+            yield job
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            await self.finish(job.id, durable)
+            raise
+        await self.finish(job.id, durable)
+
+    async def compact(self):
+        """Переписывает файл, оставляя только незавершённые задачи."""
+        if self._file is None or not self._finished:
+            return
+        # Сначала дописываем накопленное, затем снимаем состояние: между ними нет await
+        self._schedule_flush()
+        lines = [
+            json.dumps({"op": "start", "id": job_id, "job": job}, ensure_ascii=False) + "\n"
+            for job_id, job in self._jobs.items()
+        ]
+        finished, self._finished = self._finished, 0
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._rewrite, lines)
+        logger.info(f"🧹 Журнал задач сжат: убрано {finished} завершённых, осталось {len(lines)}")
+
+
+def worker_journal_path(index: int, path: str = JOURNAL_PATH) -> str:
+    """
+    Свой файл журнала для каждого воркера webhook.
+
+    Журнал читает, восстанавливает и переписывает только его владелец; номер воркера
+    (а не pid) сохраняется между перезапусками, поэтому задачи находятся снова.
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+
+async def run_compaction(journal: JobJournal, interval: float = JOURNAL_COMPACT_INTERVAL):
+    """Фоновая задача: периодически сжимает журнал задач."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await journal.compact()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сжатия журнала задач: {str(e)}")
+
+
+job_journal = JobJournal()
@@ -0,0 +1,94 @@
+"""
+Сторож event loop: находит синхронный код, который блокирует все остальные обработчики.
+
+Корутина-пульс просыпается каждые WATCHDOG_INTERVAL секунд и пишет в метрики, насколько
+опоздала. Отдельный поток следит за пульсом: если loop не отвечает дольше порога,
+он снимает стек главного потока и пишет в лог вместе с обработчиком и пользователем,
+чья задача сейчас выполняется.
+
+Включение: LOOP_WATCHDOG=1, порог в секундах — LOOP_LAG_THRESHOLD.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from metrics import LOOP_LAG_SECONDS, LOOP_STALLS, get_task_context
+
+logger = logging.getLogger(__name__)
+
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "0") != "0"
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+# Как часто пульс просыпается и поток его проверяет
+WATCHDOG_INTERVAL = 0.05
+# Сколько последних кадров стека писать в лог
+STACK_LIMIT = 25
+
+
+def _describe(context: dict) -> str:
+    if not context:
+        return "вне обработчика"
+    return ", ".join(f"{key}={value}" for key, value in context.items())
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = WATCHDOG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self._loop = None
+        self._thread_id = None
+        self._beat = 0.0
+        self._reported = None
+        self._stopped = threading.Event()
+
+    async def run(self):
+        """Пульс; запускается фоновой задачей и работает до отмены."""
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        logger.info(f"🐕 Сторож event loop включён, порог {self.threshold} с")
+        try:
+            while True:
+                expected = self._loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, self._loop.time() - expected)
+                LOOP_LAG_SECONDS.observe(lag)
+                if self._reported is not None:
+                    context, self._reported = self._reported, None
+                    LOOP_STALLS.inc(handler=context.get("handler", "unknown"))
+                    logger.warning(f"🐢 Event loop был заблокирован {lag:.2f} с ({_describe(context)})")
+                self._beat = time.monotonic()
+        finally:
+            self._stopped.set()
+
+    def _watch(self):
+        """Поток-наблюдатель: снимает стек, пока loop ещё заблокирован."""
+        reported_beat = None
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or beat == reported_beat:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT))
+            try:
+                context = get_task_context(asyncio.current_task(self._loop))
+            except RuntimeError:
+                context = {}
+            self.stalls += 1
+            self._reported = context
+            logger.warning(
+                f"🐢 Event loop не отвечает {blocked:.2f} с ({_describe(context)}), стек:\n{stack}"
+            )
+            del frame
+
+
+loop_watchdog = LoopWatchdog()
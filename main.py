@@ -1,17 +1,29 @@
 import logging
+import os
 import time
 import asyncio
-import sqlite3
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InputFile, FSInputFile
 from aiogram.exceptions import TelegramForbiddenError
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.storage.memory import MemoryStorage
-from g4f.client import Client  # Добавлен импорт клиента для генерации изображений
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from image_gen_kandinsky import Text2ImageAPI
-from image_handlers import generate_image_with_flux_and_send
+from image_handlers import (generate_image_with_flux_and_send, generate_image_with_kandinsky_and_send,
+                            resume_kandinsky_job, IMAGE_VARIANT_CHOICES)
 from text_handlers import process_user_message
+from storage import SQLiteStorage, run_maintenance
+from cache import CachedStorage
+from providers import provider_router, run_autosave, get_g4f_client
+from scheduler import job_scheduler, OverloadedError
+from response_cache import response_cache
+from state_store import create_fsm_storage
+from metrics import CallbackGauge, HandlerMetricsMiddleware, start_metrics_server, register_models
+from loop_watchdog import LOOP_WATCHDOG, loop_watchdog
+from journal import job_journal, run_compaction, JOB_MAX_AGE
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,42 +32,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Инициализация базы данных SQLite
-conn = sqlite3.connect('bot.db', check_same_thread=False)
-cursor = conn.cursor()
-
-# Таблица для настроек пользователя
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        model TEXT NOT NULL DEFAULT 'gpt-4'
-    )
-''')
-
-# Таблица для истории диалога
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS chat_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        message_type TEXT NOT NULL,
-        content TEXT NOT NULL,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (user_id)
-    )
-''')
-conn.commit()
+# Хранилище настроек и истории диалога (SQLite в отдельном потоке с кэшем в памяти)
+db = CachedStorage(SQLiteStorage('bot.db'))
+# Сжимать базу и сохранять оценки провайдеров; из нескольких воркеров webhook это делает только первый
+RUN_MAINTENANCE = True
 
 # Инициализация бота и диспетчера
-TOKEN = ""
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
+TOKEN = os.getenv("BOT_TOKEN", "")
+# Адрес своего сервера Bot API (например, локального для тестов); пусто — api.telegram.org
+TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER", "")
+if TELEGRAM_API_SERVER:
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)))
+else:
+    bot = Bot(token=TOKEN)
+# Состояние FSM: в памяти процесса или в Redis для нескольких реплик
+storage = create_fsm_storage()
 dp = Dispatcher(storage=storage)
 router = Router()
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
 dp.include_router(router)
 
 # Список доступных моделей
 TEXT_MODELS = ["llama-3.3-70b", "deepseek-v3", "deepseek-r1", "gpt-4o", "gpt-4o-mini", "gpt-4.1"]
-IMAGE_MODELS = ["flux","flux-pro", "flux-dev", "flux-schnell", "dall-e", "gpt-image"]
+IMAGE_MODELS = ["flux","flux-pro", "flux-dev", "flux-schnell", "dall-e", "gpt-image", "kandinsky"]
+register_models(*TEXT_MODELS, *IMAGE_MODELS)
 
 def get_model_keyboard_paginated(page: int = 1):
     """Создает инлайн-клавиатуру для выбора моделей с пагинацией."""
@@ -75,10 +76,23 @@ def get_model_keyboard_paginated(page: int = 1):
 TEXT2IMAGE_API_URL = ""
 TEXT2IMAGE_API_KEY = ""
 TEXT2IMAGE_SECRET_KEY = ""
-text2image_api = Text2ImageAPI(TEXT2IMAGE_API_URL, TEXT2IMAGE_API_KEY, TEXT2IMAGE_SECRET_KEY)
-
-# Инициализация клиента для генерации изображений
-g4f_client = Client()
+# Создаётся в on_startup
+text2image_api = None
+
+# Метрики, которые считываются при запросе /metrics
+CallbackGauge(
+    "bot_cache_requests_total", "Обращения к кэшам", ["cache", "result"],
+    lambda: {
+        **{tuple(name.split("_", 1)): value for name, value in db.stats().items()},
+        ("response", "hits"): response_cache.memory.hits,
+        ("response", "misses"): response_cache.memory.misses,
+    },
+    metric_type="counter",
+)
+CallbackGauge(
+    "bot_image_poll_pending", "Генерации Kandinsky в ожидании", [],
+    lambda: {(): text2image_api.poller.pending() if text2image_api else 0},
+)
 
 # Главное меню
 main_menu = ReplyKeyboardMarkup(
@@ -90,35 +104,23 @@ main_menu = ReplyKeyboardMarkup(
 
 async def get_user_model(user_id: int) -> str:
     """Получает выбранную модель пользователя из базы данных."""
-    cursor.execute("SELECT model FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    return result[0] if result else "gpt-4"
+    return await db.get_user_model(user_id)
 
 async def set_user_model(user_id: int, model: str):
     """Устанавливает выбранную модель пользователя в базу данных."""
-    cursor.execute("INSERT OR REPLACE INTO users (user_id, model) VALUES (?, ?)", (user_id, model))  # Исправлено
-    conn.commit()
+    await db.set_user_model(user_id, model)
 
 async def save_message(user_id: int, message_type: str, content: str):
     """Сохраняет сообщение в историю диалога."""
-    cursor.execute(
-        "INSERT INTO chat_history (user_id, message_type, content) VALUES (?, ?, ?)",
-        (user_id, message_type, content)
-    )
-    conn.commit()
+    await db.save_message(user_id, message_type, content)
 
 async def get_chat_history(user_id: int, limit: int = 10) -> list:
     """Получает последние сообщения из истории диалога."""
-    cursor.execute(
-        "SELECT message_type, content FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-        (user_id, limit)
-    )
-    return cursor.fetchall()[::-1]
+    return await db.get_chat_history(user_id, limit)
 
 async def clear_chat_history(user_id: int):
     """Очищает историю диалога пользователя."""
-    cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-    conn.commit()
+    await db.clear_chat_history(user_id)
 
 
 @router.message(Command("menu"))
@@ -160,27 +162,82 @@ async def select_model(callback: CallbackQuery):
     await callback.answer("Модель изменена!")
     # Не спрашиваем про промт сразу!
 
-def get_prompt_choice_keyboard():
-    """Инлайн-клавиатура для выбора способа генерации промта."""
+async def run_job(kind: str, message: Message, user_id: int, func, weight: float = 1.0):
+    """
+    Выполняет генерацию через планировщик задач.
+    Пока задача ждёт в очереди, пользователь видит свою позицию.
+    """
+    notice = None
+    started = False
+
+    async def on_queued(position: int):
+        nonlocal notice
+        notice = await message.answer(f"⏳ Ваш запрос в очереди, позиция: {position}")
+        if started:
+            await hide_notice()
+
+    async def hide_notice():
+        nonlocal notice
+        if notice:
+            try:
+                await notice.delete()
+            except Exception:
+                pass
+            notice = None
+
+    async def job():
+        nonlocal started
+        started = True
+        await hide_notice()
+        await func()
+
+    try:
+        await job_scheduler.submit(kind, user_id, job, weight=weight, on_queued=on_queued)
+    except OverloadedError:
+        logger.warning(f"Очередь {kind} переполнена, запрос пользователя {user_id} отклонён")
+        await message.answer("⚠️ Сейчас слишком много запросов. Попробуйте чуть позже.")
+
+def get_prompt_choice_keyboard(variants: int = 1):
+    """Инлайн-клавиатура для выбора способа генерации промта и числа вариантов."""
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="Сделать промт", callback_data="prompt_auto"),
-             InlineKeyboardButton(text="Использовать мой текст", callback_data="prompt_user")]
+             InlineKeyboardButton(text="Использовать мой текст", callback_data="prompt_user")],
+            [InlineKeyboardButton(text=f"✅ {count}" if count == variants else str(count),
+                                  callback_data=f"variants_{count}")
+             for count in IMAGE_VARIANT_CHOICES]
         ]
     )
     return keyboard
 
-# --- Простая память для хранения состояния пользователя (user_id: 'wait_prompt_choice' или None) ---
-user_states = {}
-user_texts = {}
+class ImagePrompt(StatesGroup):
+    """Пользователь прислал описание и выбирает способ генерации промта."""
+    waiting_choice = State()
+
+@router.callback_query(F.data.startswith("variants_"))
+async def variants_choice_handler(callback: CallbackQuery, state: FSMContext):
+    """Выбор числа вариантов изображения; запоминается до выбора способа генерации промта."""
+    variants = int(callback.data.split("_")[1])
+    if variants not in IMAGE_VARIANT_CHOICES or await state.get_state() != ImagePrompt.waiting_choice.state:
+        await callback.answer()
+        return
+    await state.update_data(variants=variants)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=get_prompt_choice_keyboard(variants))
+    except Exception:
+        pass
+    await callback.answer(f"Вариантов: {variants}")
 
 @router.callback_query(F.data.in_(["prompt_auto", "prompt_user"]))
-async def prompt_choice_handler(callback: CallbackQuery):
+async def prompt_choice_handler(callback: CallbackQuery, state: FSMContext):
     """Обработка выбора способа генерации промта для изображения."""
     user_id = callback.from_user.id
     model = await get_user_model(user_id)
-    # Получаем текст, который пользователь до этого отправил
-    user_text = user_texts.pop(user_id, None)
+    # Получаем текст, который пользователь до этого отправил, и число вариантов
+    data = await state.get_data()
+    user_text = data.get("user_text")
+    variants = data.get("variants", 1)
+    await state.clear()
     # Сначала отвечаем на callback, чтобы не было ошибки TelegramBadRequest
     await callback.answer()
     # Затем удаляем сообщение с выбором
@@ -191,13 +248,20 @@ async def prompt_choice_handler(callback: CallbackQuery):
     if not user_text:
         await callback.message.answer("Пожалуйста, сначала отправьте описание для изображения.")
         return
-    if callback.data == "prompt_auto":
+    if model.lower() == "kandinsky":
+        job = lambda: generate_image_with_kandinsky_and_send(
+            callback.message, text2image_api, user_text, auto_prompt=callback.data == "prompt_auto",
+            variants=variants
+        )
+    elif callback.data == "prompt_auto":
         # Генерируем промт автоматически
-        await generate_image_with_flux_and_send(callback.message, user_text, model)
+        job = lambda: generate_image_with_flux_and_send(callback.message, user_text, model, variants)
     else:
         # Используем текст пользователя как промт
-        await generate_image_with_flux_and_send(callback.message, user_text, model)
-    user_states[user_id] = None
+        job = lambda: generate_image_with_flux_and_send(callback.message, user_text, model, variants)
+    # Несколько вариантов занимают пул дольше: меньший вес (приоритет) в справедливой очереди
+    # сдвигает виртуальное время пользователя на variants задач вперёд
+    await run_job("image", callback.message, user_id, job, weight=1.0 / variants)
 
 @router.message(Command("delete_history"))
 async def clear_history(message: Message):
@@ -227,7 +291,7 @@ async def check_history(message: Message):
 
 
 @router.message(F.text)
-async def handle_user_message(message: Message):
+async def handle_user_message(message: Message, state: FSMContext):
     """
     Обработка текстового сообщения.
     """
@@ -237,25 +301,101 @@ async def handle_user_message(message: Message):
         # Если выбрана модель для изображений
         if model.lower() in IMAGE_MODELS:
             # Если пользователь только что выбрал модель или еще не выбрал способ генерации промта
-            if user_states.get(user_id) != 'wait_prompt_choice':
-                user_states[user_id] = 'wait_prompt_choice'
-                user_texts[user_id] = message.text
+            if await state.get_state() != ImagePrompt.waiting_choice.state:
+                await state.set_state(ImagePrompt.waiting_choice)
+                await state.update_data(user_text=message.text)
                 await message.answer(
                     "Как сгенерировать промт для изображения?",
                     reply_markup=get_prompt_choice_keyboard()
                 )
                 return
         # Для остальных моделей обрабатываем текстовое сообщение
-        history = await get_chat_history(user_id, limit=10)
-        await process_user_message(message, model, history, save_message)
+        async def job():
+            # Текст после перезапуска не продолжить, поэтому не ждём fsync перед генерацией
+            async with job_journal.track("text", durable=False, chat_id=message.chat.id):
+                history = await get_chat_history(user_id, limit=10)
+                await process_user_message(message, model, history, save_message)
+        await run_job("text", message, user_id, job)
     except TelegramForbiddenError:
         logger.warning(f"Пользователь {message.from_user.id} заблокировал бота.")
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
 
 
+background_tasks = []
+metrics_runner = None
+
+async def recover_job(job_id: str, job: dict):
+    """Доводит до пользователя задачу, прерванную перезапуском бота."""
+    try:
+        if time.time() - job.get("created", 0) > JOB_MAX_AGE:
+            return
+        if job["kind"] == "kandinsky" and job.get("uuids"):
+            logger.info(f"♻️ Восстановление генерации Kandinsky для чата {job['chat_id']}")
+            await resume_kandinsky_job(bot, text2image_api, job["chat_id"], job["uuids"], job.get("variants", 1))
+        elif job["kind"] == "text":
+            await bot.send_message(job["chat_id"], "⚠️ Ответ прервался из-за перезапуска бота. Отправьте вопрос ещё раз.")
+        else:
+            await bot.send_message(job["chat_id"], "⚠️ Генерация изображения прервалась из-за перезапуска бота. Попробуйте снова.")
+    except Exception as e:
+        logger.error(f"❌ Не удалось восстановить задачу {job_id}: {str(e)}")
+    finally:
+        await job_journal.finish(job_id)
+
+async def warm_up_g4f():
+    """Заранее импортирует g4f; ошибка импорта видна в логе сразу, а не при первом запросе."""
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, get_g4f_client)
+    except Exception as e:
+        logger.error(f"❌ Не удалось загрузить g4f: {str(e)}")
+
+async def on_startup():
+    """
+    Подготовка ресурсов перед приёмом обновлений.
+    Всё, что обращается к диску или сети, создаётся здесь, а не при импорте модуля.
+    """
+    global metrics_runner, text2image_api
+    loop = asyncio.get_running_loop()
+    text2image_api = Text2ImageAPI(TEXT2IMAGE_API_URL, TEXT2IMAGE_API_KEY, TEXT2IMAGE_SECRET_KEY)
+    await db.open()
+    await loop.run_in_executor(None, provider_router.load)
+    interrupted = await job_journal.open()
+    for job_id, job in interrupted.items():
+        background_tasks.append(asyncio.create_task(recover_job(job_id, job)))
+    background_tasks.append(asyncio.create_task(run_compaction(job_journal)))
+    metrics_runner = await start_metrics_server()
+    if RUN_MAINTENANCE:
+        background_tasks.append(asyncio.create_task(run_maintenance(db)))
+        background_tasks.append(asyncio.create_task(run_autosave(provider_router)))
+    if LOOP_WATCHDOG:
+        background_tasks.append(asyncio.create_task(loop_watchdog.run()))
+    # g4f импортируется в фоновом потоке, пока бот уже принимает обновления
+    background_tasks.append(asyncio.create_task(warm_up_g4f()))
+
+async def on_shutdown():
+    """Корректная остановка: дожидаемся начатых генераций и закрываем ресурсы."""
+    await job_scheduler.drain()
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    if RUN_MAINTENANCE:
+        provider_router.save()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    if text2image_api:
+        await text2image_api.close()
+    await response_cache.close()
+    await storage.close()
+    await job_journal.close()
+    await db.close()
+
+
 async def main():
-    await dp.start_polling(bot)
+    await on_startup()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await on_shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main())
\ No newline at end of file
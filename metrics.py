@@ -0,0 +1,315 @@
+"""
+Метрики в формате Prometheus и необязательные хуки трассировки.
+
+Метрики отдаются локальным HTTP-сервером на /metrics. Трассировка включается
+регистрацией хука через add_span_hook; без хуков span() ничего не делает.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Порт локального сервера метрик; 0 — не запускать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+# Модели, которые попадают в метку model как есть; остальные сводятся к "other",
+# чтобы произвольная строка из базы не плодила новые временные ряды
+KNOWN_MODELS = set()
+
+
+def register_models(*models):
+    KNOWN_MODELS.update(models)
+
+
+def model_label(model) -> str:
+    return model if model in KNOWN_MODELS else "other"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if "model" in labels:
+            labels = {**labels, "model": model_label(labels["model"])}
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def collect(self):
+        lines = self.header()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def collect(self):
+        lines = self.header()
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labels + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labels + ("le",), key + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """Значения считываются функцией в момент запроса /metrics: {(метки...): значение}."""
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels, func, metric_type="gauge"):
+        super().__init__(name, documentation, labels)
+        self.func = func
+        self.type = metric_type
+
+    def collect(self):
+        lines = self.header()
+        try:
+            values = self.func()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сбора метрики {self.name}: {str(e)}")
+            return lines
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Метрики конвейера ---
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время работы обработчика обновления", ["handler"])
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Время запроса к базе", ["query"])
+STREAM_FIRST_CHUNK_SECONDS = Histogram(
+    "bot_stream_first_chunk_seconds", "Время до первого куска ответа", ["model", "provider"]
+)
+STREAM_TOTAL_SECONDS = Histogram("bot_stream_total_seconds", "Полное время потокового ответа", ["model", "provider"])
+STREAM_ERRORS = Counter("bot_stream_errors_total", "Ошибки провайдеров", ["model", "provider"])
+CONTEXT_TOKENS = Histogram(
+    "bot_context_tokens", "Оценка токенов контекста в запросе", ["model"],
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000)
+)
+TELEGRAM_RETRY_AFTER_SECONDS = Counter("bot_telegram_retry_after_seconds_total", "Суммарное ожидание по RetryAfter")
+IMAGE_GENERATION_SECONDS = Histogram("bot_image_generation_seconds", "Время генерации изображения", ["model"])
+IMAGE_POLL_SECONDS = Histogram("bot_image_poll_seconds", "Время ожидания готовности изображения Kandinsky")
+IMAGE_POLL_REQUESTS = Counter("bot_image_poll_requests_total", "Запросы статуса генерации Kandinsky", ["status"])
+LOOP_LAG_SECONDS = Histogram(
+    "bot_event_loop_lag_seconds", "Опоздание event loop относительно запланированного пробуждения",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+LOOP_STALLS = Counter("bot_event_loop_stalls_total", "Блокировки event loop дольше порога", ["handler"])
+
+# --- Контекст задач ---
+
+# Какой обработчик и пользователь стоят за задачей asyncio; читается и из других потоков
+_task_context = weakref.WeakKeyDictionary()
+
+
+def set_task_context(task=None, **context):
+    """Дополняет контекст задачи (по умолчанию текущей) для логов и сторожа event loop."""
+    task = task or asyncio.current_task()
+    if task is not None:
+        _task_context[task] = {**_task_context.get(task, {}), **context}
+
+
+def get_task_context(task=None) -> dict:
+    task = task or asyncio.current_task()
+    if task is None:
+        return {}
+    return dict(_task_context.get(task, {}))
+
+# --- Трассировка ---
+
+_span_hooks = []
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        for hook in _span_hooks:
+            try:
+                hook(self.name, duration, self.attrs)
+            except Exception as e:
+                logger.error(f"❌ Ошибка хука трассировки: {str(e)}")
+        return False
+
+
+def add_span_hook(hook):
+    """Регистрирует функцию hook(name, duration, attrs), вызываемую по завершении каждого span."""
+    _span_hooks.append(hook)
+
+
+def span(name: str, **attrs):
+    """Участок трассировки; без зарегистрированных хуков возвращает общий пустой объект."""
+    if not _span_hooks:
+        return _NOOP_SPAN
+    return _Span(name, attrs)
+
+
+# --- HTTP-сервер ---
+
+async def _metrics_handler(request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str = None, port: int = None):
+    """Запускает сервер /metrics и возвращает его AppRunner (None, если выключен или порт занят)."""
+    host = host or METRICS_HOST
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.warning(f"⚠️ Сервер метрик не запущен на {host}:{port}: {str(e)}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого обработчика aiogram."""
+
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        user = getattr(event, "from_user", None)
+        set_task_context(handler=name, user_id=user.id if user else None)
+        with span("handler", handler=name), HANDLER_SECONDS.time(handler=name):
+            return await handler(event, data)
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Провайдеры g4f для текстовых моделей в порядке предпочтения по умолчанию
+DEFAULT_PROVIDERS = ["Blackbox", "PollinationsAI", "DDG"]
+# Файл, в котором оценки провайдеров переживают перезапуск
+SCORES_PATH = 'provider_scores.json'
+SCORES_SAVE_INTERVAL = 60
+# Вес нового измерения в скользящем среднем
+EWMA_ALPHA = 0.3
+# Сколько секунд не использовать провайдера после ответа о лимите
+RATE_LIMIT_COOLDOWN = 600
+# Оптимистичная оценка задержки для ещё не опробованных провайдеров
+UNKNOWN_LATENCY = 3.0
+
+
+_g4f_client = None
+_g4f_client_lock = threading.Lock()
+
+
+def get_g4f_client():
+    """
+    Общий асинхронный клиент g4f на весь процесс.
+
+    g4f со всеми провайдерами импортируется долго, поэтому клиент создаётся
+    при первом обращении (или заранее в фоне после запуска бота).
+    """
+    global _g4f_client
+    if _g4f_client is None:
+        with _g4f_client_lock:
+            if _g4f_client is None:
+                from g4f.client import AsyncClient
+                _g4f_client = AsyncClient()
+    return _g4f_client
+
+
+# Имена, о которых уже предупредили, чтобы не повторять предупреждение на каждое сообщение
+_missing_providers = set()
+
+
+def resolve_providers(names=None) -> list:
+    """Возвращает классы провайдеров g4f по именам, пропуская отсутствующие в установленной версии."""
+    from g4f import Provider
+    providers = []
+    for name in names or DEFAULT_PROVIDERS:
+        provider = getattr(Provider, name, None) if isinstance(name, str) else name
+        if provider is None:
+            if name not in _missing_providers:
+                _missing_providers.add(name)
+                logger.warning(f"⚠️ Провайдера {name} нет в установленной версии g4f, он пропущен")
+            continue
+        providers.append(provider)
+    return providers
+
+
+def provider_name(provider) -> str:
+    return getattr(provider, '__name__', str(provider))
+
+
+class ProviderStats:
+    """Скользящие оценки пары модель/провайдер."""
+
+    def __init__(self, latency=None, error_rate=0.0, rate_limited_until=0.0, requests=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limited_until = rate_limited_until
+        self.requests = requests
+
+    def score(self) -> float:
+        """Чем меньше, тем лучше: ожидаемое время до первого токена с поправкой на ошибки."""
+        latency = self.latency if self.latency is not None else UNKNOWN_LATENCY
+        return latency * (1 + 4 * self.error_rate)
+
+    def is_rate_limited(self) -> bool:
+        return self.rate_limited_until > time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "rate_limited_until": self.rate_limited_until,
+            "requests": self.requests,
+        }
+
+
+class ProviderRouter:
+    """
+    Выбор провайдера по здоровью: задержка до первого токена, доля ошибок и лимиты
+    для каждой пары модель/провайдер. Оценки сохраняются в JSON-файл.
+    """
+
+    def __init__(self, path: str = SCORES_PATH):
+        self.path = path
+        self._stats = {}
+        self._dirty = False
+
+    def _get(self, model: str, provider) -> ProviderStats:
+        key = f"{model}|{provider_name(provider)}"
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = ProviderStats()
+        return stats
+
+    def rank(self, model: str, providers: list) -> list:
+        """Сортирует провайдеров от самого быстрого здорового; ограниченные лимитом идут в конец."""
+        return sorted(
+            providers,
+            key=lambda provider: (self._get(model, provider).is_rate_limited(), self._get(model, provider).score())
+        )
+
+    def is_available(self, model: str, provider) -> bool:
+        return not self._get(model, provider).is_rate_limited()
+
+    def expected_latency(self, model: str, provider) -> float:
+        """Сглаженная задержка до первого токена; для неопробованных — UNKNOWN_LATENCY."""
+        latency = self._get(model, provider).latency
+        return latency if latency is not None else UNKNOWN_LATENCY
+
+    def record_success(self, model: str, provider, latency: float):
+        stats = self._get(model, provider)
+        stats.latency = latency if stats.latency is None else (1 - EWMA_ALPHA) * stats.latency + EWMA_ALPHA * latency
+        stats.error_rate *= 1 - EWMA_ALPHA
+        stats.requests += 1
+        self._dirty = True
+
+    def record_error(self, model: str, provider):
+        stats = self._get(model, provider)
+        stats.error_rate = (1 - EWMA_ALPHA) * stats.error_rate + EWMA_ALPHA
+        stats.requests += 1
+        self._dirty = True
+
+    def record_rate_limit(self, model: str, provider, cooldown: float = RATE_LIMIT_COOLDOWN):
+        self.record_error(model, provider)
+        self._get(model, provider).rate_limited_until = time.time() + cooldown
+        logger.warning(f"⏳ {provider_name(provider)} упёрся в лимит для {model}, пропускаем {cooldown} сек.")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self._stats = {key: ProviderStats(**value) for key, value in data.items()}
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить оценки провайдеров: {str(e)}")
+
+    def snapshot(self):
+        """
+        Сериализованные оценки или None, если с прошлого снимка ничего не менялось.
+        Вызывается в потоке event loop: словарь оценок меняется только там.
+        """
+        if not self._dirty:
+            return None
+        self._dirty = False
+        return json.dumps({key: stats.to_dict() for key, stats in self._stats.items()})
+
+    def write(self, data: str):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        data = self.snapshot()
+        if data is not None:
+            self.write(data)
+
+
+async def run_autosave(router: ProviderRouter, interval: float = SCORES_SAVE_INTERVAL):
+    """Фоновая задача: периодически сохраняет оценки провайдеров на диск."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        data = router.snapshot()
+        if data is None:
+            continue
+        try:
+            await loop.run_in_executor(None, router.write, data)
+        except Exception as e:
+            # Снимок не записан: попробуем снова в следующий раз
+            router._dirty = True
+            logger.error(f"❌ Ошибка сохранения оценок провайдеров: {str(e)}")
+
+
+provider_router = ProviderRouter()
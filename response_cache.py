@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 6 * 60 * 60
+# Путь к SQLite-файлу второго уровня кэша; None — только память
+RESPONSE_CACHE_DISK_PATH = None
+# Сколько строк хранить на диске: при очистке старые ответы вытесняются первыми
+RESPONSE_CACHE_DISK_SIZE = 10000
+# Как часто удалять просроченные и лишние строки (в секундах); чаще, если записей много
+RESPONSE_CACHE_SWEEP_INTERVAL = 600
+# Кэшировать ли ответы в диалогах с историей (по умолчанию только первые вопросы)
+CACHE_WITH_HISTORY = False
+# Размер куска при воспроизведении ответа из кэша
+REPLAY_CHUNK_SIZE = 200
+
+
+def normalize_prompt(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def history_fingerprint(history) -> str:
+    if not history:
+        return ""
+    return hashlib.sha256(json.dumps(list(history), ensure_ascii=False).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш ответов по содержимому запроса: модель, нормализованный промт и отпечаток истории.
+    Первый уровень в памяти (LRU + TTL), второй — необязательная таблица SQLite
+    не больше disk_maxsize строк; просроченные и лишние строки удаляются периодически.
+    """
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 disk_path: str = RESPONSE_CACHE_DISK_PATH, cache_with_history: bool = CACHE_WITH_HISTORY,
+                 disk_maxsize: int = RESPONSE_CACHE_DISK_SIZE, sweep_interval: float = RESPONSE_CACHE_SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_maxsize = disk_maxsize
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+        self._writes_since_sweep = 0
+        self.cache_with_history = cache_with_history
+        self.memory = LRUCache(maxsize, ttl)
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache") if disk_path else None
+
+    @staticmethod
+    def key(model: str, prompt: str, history=None) -> str:
+        raw = "\0".join((model.lower(), normalize_prompt(prompt), history_fingerprint(history)))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def enabled_for(self, history) -> bool:
+        return not history or self.cache_with_history
+
+    # --- Дисковый уровень ---
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires)")
+            self._conn.commit()
+        return self._conn
+
+    def _disk_get(self, key: str):
+        row = self._connect().execute(
+            "SELECT value FROM response_cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _disk_set(self, key: str, value: str):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, now + self.ttl)
+        )
+        self._writes_since_sweep += 1
+        # Между очистками таблица может вырасти не больше чем на десятую часть лимита
+        if now >= self._next_sweep or self._writes_since_sweep >= max(1, self.disk_maxsize // 10):
+            self._sweep(conn, now)
+        conn.commit()
+
+    def _sweep(self, conn, now: float):
+        """Удаляет просроченные строки и самые старые сверх disk_maxsize (по индексу на expires)."""
+        conn.execute("DELETE FROM response_cache WHERE expires <= ?", (now,))
+        conn.execute(
+            "DELETE FROM response_cache WHERE expires <= ("
+            "SELECT expires FROM response_cache ORDER BY expires DESC LIMIT 1 OFFSET ?)",
+            (self.disk_maxsize,)
+        )
+        self._next_sweep = now + self.sweep_interval
+        self._writes_since_sweep = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # --- Общий интерфейс ---
+
+    async def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None or self._executor is None:
+            return value
+        try:
+            value = await self._run(self._disk_get, key)
+        except Exception as e:
+            logger.error(f"❌ Ошибка чтения кэша ответов: {str(e)}")
+            return None
+        if value is not None:
+            self.memory.set(key, value)
+        return value
+
+    async def set(self, key: str, value: str):
+        self.memory.set(key, value)
+        if self._executor is None:
+            return
+        try:
+            await self._run(self._disk_set, key, value)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи кэша ответов: {str(e)}")
+
+    async def close(self):
+        if self._executor is None:
+            return
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+async def replay_cached(text: str, queue: asyncio.Queue, chunk_size: int = REPLAY_CHUNK_SIZE):
+    """Отдаёт закэшированный ответ в очередь так же, как это делает генерация."""
+    for start in range(0, len(text), chunk_size):
+        await queue.put(text[start:start + chunk_size])
+    await queue.put(None)
+
+
+response_cache = ResponseCache()
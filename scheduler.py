@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from metrics import CallbackGauge, get_task_context, set_task_context
+
+logger = logging.getLogger(__name__)
+
+# Пулы задач: сколько задач выполняется одновременно, сколько из них у одного пользователя,
+# сколько задач может ждать в очереди всего и у одного пользователя
+POOLS = {
+    "text": {"concurrency": 32, "per_user": 1, "max_queue": 500, "per_user_queue": 3},
+    "image": {"concurrency": 4, "per_user": 1, "max_queue": 100, "per_user_queue": 2},
+}
+
+
+class OverloadedError(Exception):
+    """Очередь переполнена, задача не принята."""
+
+
+class _Job:
+    def __init__(self, user_id: int, func, start: float, tag: float):
+        self.user_id = user_id
+        self.func = func
+        self.start = start
+        self.tag = tag
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+        # Обработчик, поставивший задачу: задача выполняется в другой задаче asyncio
+        self.context = get_task_context()
+
+
+class FairPool:
+    """
+    Пул задач одного вида с ограничением параллельности.
+
+    Очередь взвешенно-справедливая (WFQ): у каждой задачи есть виртуальное время завершения,
+    которое растёт с каждой задачей пользователя обратно пропорционально его весу.
+    Поэтому пользователь, приславший много сообщений подряд, не вытесняет остальных.
+    """
+
+    def __init__(self, name: str, concurrency: int, per_user: int, max_queue: int, per_user_queue: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.per_user_queue = per_user_queue
+        self._queues = {}
+        self._last_tag = {}
+        self._running = {}
+        self._running_total = 0
+        self._queued_total = 0
+        self._virtual_time = 0.0
+        self.closed = False
+
+    def stats(self) -> dict:
+        return {"running": self._running_total, "queued": self._queued_total}
+
+    def busy(self) -> bool:
+        return bool(self._running_total or self._queued_total)
+
+    def position(self, job: _Job) -> int:
+        """Примерное место задачи в очереди, начиная с 1."""
+        ahead = sum(1 for queue in self._queues.values() for other in queue if other.tag < job.tag)
+        return ahead + 1
+
+    async def submit(self, user_id: int, func, weight: float = 1.0, on_queued=None):
+        """Ставит задачу в очередь и ждёт её результата."""
+        queue = self._queues.get(user_id)
+        if self.closed or self._queued_total >= self.max_queue or (queue and len(queue) >= self.per_user_queue):
+            raise OverloadedError(self.name)
+
+        start = max(self._virtual_time, self._last_tag.get(user_id, 0.0))
+        job = _Job(user_id, func, start, start + 1.0 / weight)
+        self._last_tag[user_id] = job.tag
+        self._queues.setdefault(user_id, deque()).append(job)
+        self._queued_total += 1
+        self._dispatch()
+
+        try:
+            if job.task is None and on_queued is not None:
+                try:
+                    await on_queued(self.position(job))
+                except Exception as e:
+                    # Уведомление о месте в очереди необязательно: задача остаётся в очереди и её ждут
+                    logger.warning(f"⚠️ Не удалось сообщить о месте в очереди {self.name}: {str(e)}")
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if job.task is None:
+                self._remove(job)
+            else:
+                job.task.cancel()
+            raise
+
+    def _remove(self, job: _Job):
+        queue = self._queues.get(job.user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            self._queued_total -= 1
+            if not queue:
+                del self._queues[job.user_id]
+
+    def _dispatch(self):
+        while self._running_total < self.concurrency:
+            job = None
+            for user_id, queue in self._queues.items():
+                if self._running.get(user_id, 0) >= self.per_user:
+                    continue
+                if job is None or queue[0].tag < job.tag:
+                    job = queue[0]
+            if job is None:
+                return
+            self._remove(job)
+            self._virtual_time = max(self._virtual_time, job.start)
+            self._running[job.user_id] = self._running.get(job.user_id, 0) + 1
+            self._running_total += 1
+            job.task = asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: _Job):
+        set_task_context(**job.context, pool=self.name)
+        try:
+            result = await job.func()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running_total -= 1
+            self._running[job.user_id] -= 1
+            if not self._running[job.user_id]:
+                del self._running[job.user_id]
+                if job.user_id not in self._queues:
+                    self._last_tag.pop(job.user_id, None)
+            self._dispatch()
+
+
+class JobScheduler:
+    """Набор пулов задач между обработчиками aiogram и генераторами."""
+
+    def __init__(self, pools: dict = None):
+        self.pools = {name: FairPool(name, **options) for name, options in (pools or POOLS).items()}
+
+    def stats(self) -> dict:
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    async def submit(self, kind: str, user_id: int, func, weight: float = 1.0, on_queued=None):
+        return await self.pools[kind].submit(user_id, func, weight, on_queued)
+
+    async def drain(self, timeout: float = 60.0):
+        """Перестаёт принимать новые задачи и ждёт завершения уже принятых."""
+        for pool in self.pools.values():
+            pool.closed = True
+        deadline = time.monotonic() + timeout
+        while any(pool.busy() for pool in self.pools.values()):
+            if time.monotonic() > deadline:
+                logger.warning(f"⚠️ Не дождались завершения задач: {self.stats()}")
+                return
+            await asyncio.sleep(0.1)
+
+
+job_scheduler = JobScheduler()
+
+CallbackGauge(
+    "bot_queue_depth", "Задачи в пулах планировщика", ["pool", "state"],
+    lambda: {
+        (name, state): value
+        for name, stats in job_scheduler.stats().items()
+        for state, value in stats.items()
+    },
+)
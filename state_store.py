@@ -0,0 +1,84 @@
+import logging
+import os
+import time
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+# Адрес Redis для общего состояния между репликами бота; пусто — хранение в памяти процесса
+REDIS_URL = os.getenv("REDIS_URL", "")
+# Через сколько секунд бездействия забывать состояние пользователя
+STATE_TTL = 60 * 60
+# Как часто вычищать устаревшие записи из памяти
+SWEEP_INTERVAL = 60
+
+
+class TTLMemoryStorage(MemoryStorage):
+    """
+    Хранилище FSM в памяти процесса, которое забывает неактивные записи.
+
+    Обычный MemoryStorage создаёт запись для каждого пользователя, приславшего хотя бы
+    одно сообщение, и никогда её не удаляет.
+    """
+
+    def __init__(self, ttl: float = STATE_TTL):
+        super().__init__()
+        self.ttl = ttl
+        self._expires = {}
+        self._next_sweep = 0.0
+
+    def _forget(self, key: StorageKey):
+        self.storage.pop(key, None)
+        self._expires.pop(key, None)
+
+    def _touch(self, key: StorageKey):
+        now = time.monotonic()
+        record = self.storage.get(key)
+        if record is not None and record.state is None and not record.data:
+            self._forget(key)
+        else:
+            self._expires[key] = now + self.ttl
+        if now >= self._next_sweep:
+            self._next_sweep = now + SWEEP_INTERVAL
+            for expired in [k for k, expires in self._expires.items() if expires <= now]:
+                self._forget(expired)
+
+    def _alive(self, key: StorageKey) -> bool:
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._forget(key)
+        return key in self.storage
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        await super().set_state(key, state)
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey):
+        if not self._alive(key):
+            return None
+        return await super().get_state(key)
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await super().set_data(key, data)
+        self._touch(key)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        if not self._alive(key):
+            return {}
+        return await super().get_data(key)
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default=None):
+        if not self._alive(storage_key):
+            return default
+        return await super().get_value(storage_key, dict_key, default)
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Redis, если задан REDIS_URL (нужен для нескольких реплик), иначе память процесса."""
+    if REDIS_URL:
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        logger.info("Состояние FSM хранится в Redis")
+        return RedisStorage.from_url(REDIS_URL, state_ttl=STATE_TTL, data_ttl=STATE_TTL)
+    return TTLMemoryStorage()
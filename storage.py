@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from metrics import DB_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-4"
+
+# Ограничения истории диалога: число пар вопрос-ответ на пользователя и максимальный возраст
+HISTORY_MAX_TURNS = 50
+HISTORY_MAX_AGE_DAYS = 30
+# Как часто запускать сжатие истории и как часто можно делать VACUUM (в секундах)
+COMPACTION_INTERVAL = 600
+VACUUM_INTERVAL = 24 * 60 * 60
+# Доля свободных страниц в файле, при которой VACUUM имеет смысл
+VACUUM_FREE_RATIO = 0.25
+
+# Миграции схемы: номер версии записывается в PRAGMA user_version.
+# Первая миграция повторяет исходную схему, поэтому существующие bot.db обновляются на месте.
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        model TEXT NOT NULL DEFAULT 'gpt-4'
+    );
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message_type TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    );
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_chat_history_user_id ON chat_history (user_id, id);
+    ''',
+]
+
+
+class BaseStorage(ABC):
+    """
+    Интерфейс хранилища настроек пользователей и истории диалога.
+
+    Бэкенд без какого-либо из абстрактных методов не создаётся; open, close и compact необязательны.
+    """
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def get_user_model(self, user_id: int) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_user_model(self, user_id: int, model: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_message(self, user_id: int, message_type: str, content: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_chat_history(self, user_id: int, limit: int = 10) -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def clear_chat_history(self, user_id: int):
+        raise NotImplementedError
+
+    async def compact(self) -> int:
+        """Удаляет устаревшую историю, возвращает число удалённых строк."""
+        return 0
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище на SQLite, не блокирующее event loop.
+
+    Все запросы выполняются в отдельном потоке-писателе, который владеет
+    соединением. Вставки в chat_history копятся и коммитятся пачкой
+    (group commit): одна транзакция на batch_size сообщений или на flush_interval секунд.
+    История каждого пользователя ограничена max_turns парами сообщений и max_age_days днями.
+    """
+
+    def __init__(self, path: str = 'bot.db', batch_size: int = 200, flush_interval: float = 0.01,
+                 max_turns: int = HISTORY_MAX_TURNS, max_age_days: int = HISTORY_MAX_AGE_DAYS):
+        self.path = path
+        self.max_turns = max_turns
+        self.max_age_days = max_age_days
+        self._last_vacuum = 0.0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._conn = None
+        self._pending = []
+        self._flush_handle = None
+
+    async def _run(self, func, *args, query: str = None):
+        """Выполняет функцию в потоке-писателе."""
+        loop = asyncio.get_running_loop()
+        with DB_QUERY_SECONDS.time(query=query or func.__name__.lstrip('_')):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn = conn
+        self._migrate()
+
+    def _migrate(self):
+        """Применяет недостающие миграции схемы."""
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"🛠 Миграция базы {self.path} до версии {number}")
+            self._conn.executescript(f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
+
+    async def open(self):
+        if self._conn is None:
+            await self._run(self._connect)
+
+    async def close(self):
+        if self._conn is None:
+            return
+        await self._flush()
+        await self._run(self._conn.close)
+        self._conn = None
+        self._executor.shutdown(wait=True)
+
+    # --- Пакетная запись истории ---
+
+    def _schedule_flush(self):
+        """Отправляет накопленные вставки в поток-писатель, не дожидаясь результата."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return None
+        batch, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        write = loop.run_in_executor(self._executor, self._write_batch, [row for row, _ in batch])
+
+        def _resolve(task):
+            error = task.exception()
+            for _, waiter in batch:
+                if waiter.done():
+                    continue
+                if error:
+                    waiter.set_exception(error)
+                else:
+                    waiter.set_result(None)
+
+        write.add_done_callback(_resolve)
+        return write
+
+    async def _flush(self):
+        write = self._schedule_flush()
+        if write is not None:
+            await asyncio.shield(write)
+
+    def _write_batch(self, rows: list):
+        started = time.perf_counter()
+        try:
+            self._conn.executemany(
+                "INSERT INTO chat_history (user_id, message_type, content) VALUES (?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+        except Exception as e:
+            self._conn.rollback()
+            logger.error(f"❌ Ошибка записи истории: {str(e)}")
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, query="save_message_batch")
+
+    # --- Запросы ---
+
+    def _fetchone(self, query: str, params: tuple):
+        return self._conn.execute(query, params).fetchone()
+
+    def _fetchall(self, query: str, params: tuple):
+        return self._conn.execute(query, params).fetchall()
+
+    def _execute(self, query: str, params: tuple):
+        self._conn.execute(query, params)
+        self._conn.commit()
+
+    async def get_user_model(self, user_id: int) -> str:
+        result = await self._run(
+            self._fetchone, "SELECT model FROM users WHERE user_id = ?", (user_id,), query="get_user_model"
+        )
+        return result[0] if result else DEFAULT_MODEL
+
+    async def set_user_model(self, user_id: int, model: str):
+        await self._run(
+            self._execute,
+            "INSERT OR REPLACE INTO users (user_id, model) VALUES (?, ?)",
+            (user_id, model),
+            query="set_user_model"
+        )
+
+    async def save_message(self, user_id: int, message_type: str, content: str):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._pending.append(((user_id, message_type, content), waiter))
+        if len(self._pending) >= self.batch_size:
+            self._schedule_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._schedule_flush)
+        await waiter
+
+    async def get_chat_history(self, user_id: int, limit: int = 10) -> list:
+        # Поток-писатель выполняет задачи по очереди, поэтому чтение увидит все сохранённые ранее сообщения
+        self._schedule_flush()
+        rows = await self._run(
+            self._fetchall,
+            "SELECT message_type, content FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit),
+            query="get_chat_history"
+        )
+        return rows[::-1]
+
+    async def clear_chat_history(self, user_id: int):
+        self._schedule_flush()
+        await self._run(
+            self._execute, "DELETE FROM chat_history WHERE user_id = ?", (user_id,), query="clear_chat_history"
+        )
+
+    # --- Обслуживание ---
+
+    def _compact(self) -> int:
+        deleted = self._conn.execute(
+            "DELETE FROM chat_history WHERE timestamp < datetime('now', ?)",
+            (f"-{self.max_age_days} days",)
+        ).rowcount
+        max_rows = self.max_turns * 2
+        overflow = self._conn.execute(
+            "SELECT user_id FROM chat_history GROUP BY user_id HAVING COUNT(*) > ?",
+            (max_rows,)
+        ).fetchall()
+        for (user_id,) in overflow:
+            deleted += self._conn.execute(
+                """
+                DELETE FROM chat_history WHERE user_id = ? AND id <= (
+                    SELECT id FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (user_id, user_id, max_rows)
+            ).rowcount
+        self._conn.commit()
+        return deleted
+
+    def _vacuum_if_needed(self):
+        now = time.monotonic()
+        if self._last_vacuum and now - self._last_vacuum < VACUUM_INTERVAL:
+            return
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if page_count and freelist / page_count >= VACUUM_FREE_RATIO:
+            logger.info(f"🧹 VACUUM {self.path}: свободно {freelist} из {page_count} страниц")
+            self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._last_vacuum = now
+
+    async def compact(self) -> int:
+        self._schedule_flush()
+        deleted = await self._run(self._compact)
+        if deleted:
+            logger.info(f"🧹 Удалено {deleted} устаревших сообщений из истории")
+        await self._run(self._vacuum_if_needed)
+        return deleted
+
+
+async def run_maintenance(storage: BaseStorage, interval: float = COMPACTION_INTERVAL):
+    """Фоновая задача: периодически сжимает историю диалогов."""
+    while True:
+        try:
+            await storage.compact()
+        except Exception as e:
+            logger.error(f"❌ Ошибка обслуживания базы: {str(e)}")
+        await asyncio.sleep(interval)
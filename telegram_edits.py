@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import time
+from aiogram.types import Message
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from cache import LRUCache
+from metrics import CallbackGauge, TELEGRAM_RETRY_AFTER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 в секунду в одном чате
+GLOBAL_EDITS_PER_SECOND = 25.0
+GLOBAL_BURST = 30
+CHAT_EDITS_PER_SECOND = 1.0
+CHAT_BURST = 2
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class _PendingEdit:
+    def __init__(self, message: Message, text: str, parse_mode):
+        self.message = message
+        self.text = text
+        self.parse_mode = parse_mode
+        self.waiters = []
+
+
+class EditScheduler:
+    """
+    Центральный планировщик правок сообщений для потоковых ответов.
+
+    Для каждого сообщения хранится только последний ожидающий текст, промежуточные кадры
+    отбрасываются. Правки отправляются с учётом общего лимита бота и лимита каждого чата,
+    одинаковый текст повторно не отправляется. schedule() никогда не блокирует вызывающего.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_EDITS_PER_SECOND, chat_rate: float = CHAT_EDITS_PER_SECOND):
+        self.chat_rate = chat_rate
+        self._global = TokenBucket(global_rate, GLOBAL_BURST)
+        self._chats = LRUCache(maxsize=10000)
+        self._pending = {}
+        self._in_flight = set()
+        # Ссылки на задачи отправки, чтобы сборщик мусора не удалил их на середине
+        self._sends = set()
+        self._last_sent = LRUCache(maxsize=10000)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.edits_sent = 0
+        self.edits_coalesced = 0
+        self.edits_skipped = 0
+        self.retry_after_waits = 0
+
+    def stats(self) -> dict:
+        return {
+            "edits_sent": self.edits_sent,
+            "edits_coalesced": self.edits_coalesced,
+            "edits_skipped": self.edits_skipped,
+            "retry_after_waits": self.retry_after_waits,
+            "edits_pending": len(self._pending),
+        }
+
+    @staticmethod
+    def _key(message: Message):
+        return message.chat.id, message.message_id
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, CHAT_BURST)
+            self._chats.set(chat_id, bucket)
+        return bucket
+
+    def schedule(self, message: Message, text: str, parse_mode='Markdown'):
+        """Ставит правку в очередь, заменяя ещё не отправленный текст этого сообщения."""
+        return self._enqueue(message, text, parse_mode)
+
+    async def flush(self, message: Message, text: str, parse_mode='Markdown'):
+        """Ставит правку в очередь и ждёт, пока она будет доставлена."""
+        waiter = self._enqueue(message, text, parse_mode, wait=True)
+        if waiter is not None:
+            await waiter
+
+    def forget(self, message: Message):
+        """Забывает последний отправленный текст сообщения, когда ответ завершён."""
+        self._last_sent.pop(self._key(message))
+
+    def _enqueue(self, message: Message, text: str, parse_mode, wait: bool = False):
+        key = self._key(message)
+        pending = self._pending.get(key)
+        if pending is None:
+            if key not in self._in_flight and self._last_sent.get(key) == text:
+                self.edits_skipped += 1
+                return None
+            pending = self._pending[key] = _PendingEdit(message, text, parse_mode)
+        else:
+            self.edits_coalesced += 1
+            pending.text = text
+            pending.parse_mode = parse_mode
+        waiter = None
+        if wait:
+            waiter = asyncio.get_running_loop().create_future()
+            pending.waiters.append(waiter)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return waiter
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            next_delay = None
+            for key in list(self._pending):
+                if key in self._in_flight:
+                    continue
+                delay = max(self._global.delay(now), self._chat_bucket(key[0]).delay(now))
+                if delay > 0:
+                    next_delay = delay if next_delay is None else min(next_delay, delay)
+                    continue
+                pending = self._pending.pop(key)
+                self._global.take(now)
+                self._chat_bucket(key[0]).take(now)
+                self._in_flight.add(key)
+                task = asyncio.create_task(self._send(key, pending))
+                self._sends.add(task)
+                task.add_done_callback(self._sends.discard)
+            self._wakeup.clear()
+            if not self._pending and not self._in_flight:
+                # Нечего отправлять: ждём новых правок
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=next_delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, key, pending: _PendingEdit):
+        requeue = False
+        try:
+            if self._last_sent.get(key) == pending.text:
+                self.edits_skipped += 1
+                return
+            try:
+                await pending.message.edit_text(pending.text, parse_mode=pending.parse_mode)
+            except TelegramBadRequest as e:
+                if "not modified" in str(e):
+                    pass
+                elif pending.parse_mode and "can't parse entities" in str(e):
+                    # Незакрытая разметка в середине потока: отправляем как обычный текст
+                    await pending.message.edit_text(pending.text)
+                else:
+                    raise
+            self.edits_sent += 1
+            self._last_sent.set(key, pending.text)
+        except TelegramRetryAfter as e:
+            logger.warning(f"⏳ Превышен лимит Telegram, ждем {e.retry_after} сек.")
+            self.retry_after_waits += 1
+            TELEGRAM_RETRY_AFTER_SECONDS.inc(e.retry_after)
+            # Flood wait может относиться ко всему боту, поэтому ждут и общий лимит, и лимит чата
+            self._global.pause(e.retry_after)
+            self._chat_bucket(key[0]).pause(e.retry_after)
+            requeue = True
+        except Exception as e:
+            logger.error(f"❌ Ошибка редактирования: {str(e)}")
+        finally:
+            self._in_flight.discard(key)
+            if requeue:
+                newer = self._pending.get(key)
+                if newer is None:
+                    self._pending[key] = pending
+                else:
+                    newer.waiters.extend(pending.waiters)
+            else:
+                for waiter in pending.waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+            self._wakeup.set()
+
+
+edit_scheduler = EditScheduler()
+
+CallbackGauge(
+    "bot_telegram_edits_total", "Правки сообщений по результату", ["result"],
+    lambda: {
+        ("sent",): edit_scheduler.edits_sent,
+        ("coalesced",): edit_scheduler.edits_coalesced,
+        ("skipped",): edit_scheduler.edits_skipped,
+        ("retry_after",): edit_scheduler.retry_after_waits,
+    },
+    metric_type="counter",
+)
+CallbackGauge(
+    "bot_telegram_edits_pending", "Правки, ожидающие отправки", [],
+    lambda: {(): len(edit_scheduler._pending)},
+)
+
+
+# Максимальная длина сообщения Telegram и запас под закрытие блока кода при переносе
+TELEGRAM_MESSAGE_LIMIT = 4096
+SPLIT_RESERVE = 32
+
+
+def _split_point(text: str, limit: int) -> int:
+    """Ищет безопасное место разрыва: абзац, строка или пробел ближе к концу."""
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, 0, limit)
+        if position > limit // 2:
+            return position + len(separator)
+    return limit
+
+
+def _open_fence(text: str):
+    """Если в тексте остался незакрытый блок кода, возвращает его язык, иначе None."""
+    if text.count("```") % 2 == 0:
+        return None
+    opening = text.rfind("```") + 3
+    line_end = text.find("\n", opening)
+    language = text[opening:line_end] if line_end != -1 else ""
+    return language.strip()
+
+
+class StreamRenderer:
+    """
+    Инкрементальная отрисовка потокового ответа в одно или несколько сообщений.
+
+    Куски ответа копятся в списке, редактируется только последнее (активное) сообщение.
+    Когда оно заполняется, текст разрывается по безопасной границе, открытый блок кода
+    закрывается и переоткрывается в новом сообщении.
+    """
+
+    def __init__(self, message: Message, scheduler: EditScheduler = None, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.scheduler = scheduler or edit_scheduler
+        self.limit = limit
+        self.messages = [message]
+        # Окончательные тексты заполненных сообщений, по одному на каждое, кроме последнего
+        self._final_texts = []
+        self._chunks = []
+        self._parts = []
+        self._length = 0
+        self._prefix = ""
+
+    @property
+    def tail(self) -> Message:
+        return self.messages[-1]
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def _render(self) -> str:
+        return self._prefix + "".join(self._parts)
+
+    async def append(self, chunk: str):
+        if not chunk:
+            return
+        self._chunks.append(chunk)
+        self._parts.append(chunk)
+        self._length += len(chunk)
+        while len(self._prefix) + self._length > self.limit - SPLIT_RESERVE:
+            await self._split()
+        self.scheduler.schedule(self.tail, self._render())
+
+    async def _split(self):
+        body = "".join(self._parts)
+        cut = _split_point(body, self.limit - SPLIT_RESERVE - len(self._prefix))
+        head, rest = body[:cut], body[cut:]
+        final_text = self._prefix + head
+        language = _open_fence(final_text)
+        if language is not None:
+            final_text = final_text.rstrip("\n") + "\n```"
+            self._prefix = f"```{language}\n"
+        else:
+            self._prefix = ""
+        # Заполненное сообщение больше не меняется, отправляем его окончательный вариант
+        self.scheduler.schedule(self.tail, final_text)
+        self._final_texts.append(final_text)
+        self.messages.append(await self.tail.answer("⏳"))
+        self._parts = [rest]
+        self._length = len(rest)
+
+    async def finish(self):
+        """Дожидается доставки окончательного текста всех сообщений."""
+        texts = self._final_texts + [self._render()]
+        await asyncio.gather(*(self.scheduler.flush(message, text) for message, text in zip(self.messages, texts)))
+
+    def forget(self):
+        for message in self.messages:
+            self.scheduler.forget(message)
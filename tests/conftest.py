@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py создаёт Bot при импорте, а metrics читает порт при импорте
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("METRICS_PORT", "0")
@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import image_handlers
+import main
+
+
+class FakeMessage:
+    def __init__(self, events: list, user_id: int = 1):
+        self.events = events
+        self.chat = SimpleNamespace(id=user_id)
+        self.from_user = SimpleNamespace(id=user_id)
+        self.bot = SimpleNamespace(send_photo=self._send_photo)
+
+    async def answer(self, text, **kwargs):
+        self.events.append(("answer", text))
+        return self
+
+    async def delete(self):
+        pass
+
+    async def _send_photo(self, chat_id, photo):
+        self.events.append(("photo", photo))
+
+
+class SlowImages:
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def generate(self, **kwargs):
+        await asyncio.sleep(self.delay)
+        return SimpleNamespace(data=[SimpleNamespace(url="https://example.com/image.png")])
+
+
+async def create_completion(**kwargs):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="A fox in the forest"))])
+
+
+def test_handlers_respond_while_image_generates(tmp_path, monkeypatch):
+    client = SimpleNamespace(
+        images=SlowImages(0.5),
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create_completion)),
+    )
+    monkeypatch.setattr(image_handlers, "get_g4f_client", lambda: client)
+    monkeypatch.setattr(main.db.backend, "path", str(tmp_path / "bot.db"))
+
+    async def scenario():
+        await main.db.open()
+        try:
+            events = []
+            image = asyncio.create_task(
+                image_handlers.generate_image_with_flux_and_send(FakeMessage(events), "лиса", "flux")
+            )
+            await asyncio.sleep(0.05)
+            # Пока изображение генерируется, другой пользователь получает ответ на /start
+            await asyncio.wait_for(main.cmd_start(FakeMessage(events, user_id=2)), timeout=0.3)
+            assert not image.done()
+            await image
+            return events
+        finally:
+            await main.db.close()
+
+    events = asyncio.run(scenario())
+    start_reply = next(i for i, event in enumerate(events) if event[0] == "answer" and "Привет" in event[1])
+    photo = next(i for i, event in enumerate(events) if event[0] == "photo")
+    assert start_reply < photo
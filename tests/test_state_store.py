@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+import state_store
+from state_store import TTLMemoryStorage, create_fsm_storage
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+
+def test_memory_storage_read_does_not_create_record():
+    async def scenario():
+        storage = TTLMemoryStorage()
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        assert await storage.get_value(KEY, "user_text") is None
+        return storage
+
+    storage = asyncio.run(scenario())
+    assert KEY not in storage.storage
+
+
+def test_memory_storage_expires_inactive_records():
+    async def scenario():
+        storage = TTLMemoryStorage(ttl=0.05)
+        await storage.set_state(KEY, "ImagePrompt:waiting_choice")
+        await storage.set_data(KEY, {"user_text": "лиса"})
+        assert await storage.get_state(KEY) == "ImagePrompt:waiting_choice"
+        await asyncio.sleep(0.1)
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        return storage
+
+    storage = asyncio.run(scenario())
+    assert KEY not in storage.storage
+
+
+def test_memory_storage_sweeps_other_users(monkeypatch):
+    monkeypatch.setattr(state_store, "SWEEP_INTERVAL", 0)
+    other = StorageKey(bot_id=1, chat_id=7, user_id=7)
+
+    async def scenario():
+        storage = TTLMemoryStorage(ttl=0.05)
+        await storage.set_state(other, "ImagePrompt:waiting_choice")
+        await asyncio.sleep(0.1)
+        # Запись другого пользователя удаляется при очередной записи, даже если её никто не читает
+        await storage.set_state(KEY, "ImagePrompt:waiting_choice")
+        return storage
+
+    storage = asyncio.run(scenario())
+    assert other not in storage.storage
+    assert KEY in storage.storage
+
+
+def test_memory_storage_forgets_cleared_state():
+    async def scenario():
+        storage = TTLMemoryStorage()
+        await storage.set_state(KEY, "ImagePrompt:waiting_choice")
+        await storage.set_data(KEY, {"user_text": "лиса"})
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        return storage
+
+    storage = asyncio.run(scenario())
+    assert KEY not in storage.storage
+
+
+def test_create_fsm_storage_without_redis_url(monkeypatch):
+    monkeypatch.setattr(state_store, "REDIS_URL", "")
+    assert isinstance(create_fsm_storage(), TTLMemoryStorage)
+
+
+def test_create_fsm_storage_shares_state_through_redis(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis_module = pytest.importorskip("aiogram.fsm.storage.redis")
+    server = fakeredis.FakeServer()
+    clients = []
+
+    def fake_redis(connection_pool):
+        client = fakeredis.FakeAsyncRedis(server=server)
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(state_store, "REDIS_URL", "redis://localhost:6379/0")
+    monkeypatch.setattr(redis_module, "Redis", fake_redis)
+
+    async def scenario():
+        # Две реплики бота с общим Redis
+        first, second = create_fsm_storage(), create_fsm_storage()
+        assert isinstance(first, redis_module.RedisStorage)
+        await first.set_state(KEY, "ImagePrompt:waiting_choice")
+        await first.set_data(KEY, {"user_text": "лиса"})
+        state = await second.get_state(KEY)
+        data = await second.get_data(KEY)
+        ttls = [await clients[0].ttl(key) for key in await clients[0].keys("*")]
+        await first.close()
+        await second.close()
+        return state, data, ttls
+
+    state, data, ttls = asyncio.run(scenario())
+    assert state == "ImagePrompt:waiting_choice"
+    assert data == {"user_text": "лиса"}
+    assert ttls and all(0 < ttl <= state_store.STATE_TTL for ttl in ttls)
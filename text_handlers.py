@@ -1,76 +1,216 @@
 import asyncio
 import logging
 from aiogram.types import Message
-from aiogram.exceptions import TelegramRetryAfter
-import g4f
-from g4f import Provider
 import time
+from providers import provider_router, provider_name, resolve_providers
+from telegram_edits import edit_scheduler, StreamRenderer
+from response_cache import response_cache, replay_cached
+from context_builder import build_messages
+from metrics import (
+    STREAM_FIRST_CHUNK_SECONDS, STREAM_TOTAL_SECONDS, STREAM_ERRORS, CONTEXT_TOKENS, span
+)
 
 logger = logging.getLogger(__name__)
 
 BLACKBOX_LIMIT_MSG = "You have reached your request limit for the hour."
+LIMIT_ERROR_TEXT = "⚠️ Произошла ошибка при генерации ответа, попробуйте позже\nИли выберите другую модель"
+# Сколько символов предыдущих кусков проверять вместе с новым, чтобы найти разрезанное сообщение о лимите
+LIMIT_SCAN_OVERLAP = len(BLACKBOX_LIMIT_MSG) - 1
+# Сколько кусков ответа может ждать отрисовки, прежде чем генерация приостановится
+STREAM_QUEUE_SIZE = 64
+# Сколько секунд ждать очередного куска ответа, прежде чем сдаться
+STREAM_CHUNK_TIMEOUT = 35.0
 
-async def generate_gpt_stream(messages: list, model: str, queue: asyncio.Queue, providers: list):
+# Подключать ли второго провайдера, если первый медлит с первым токеном; побеждает ответивший первым
+HEDGE_REQUESTS = True
+# Второй запрос уходит, только если первый молчит дольше своей обычной задержки (но не раньше этого)
+HEDGE_MIN_DELAY = 1.0
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Referer': 'https://www.google.com/',
+    'Origin': 'https://www.google.com/'
+}
+
+
+class ProviderLimitError(Exception):
+    """Провайдер сообщил о превышении лимита запросов."""
+
+
+def _limit_prefix_length(text: str) -> int:
+    """Длина самого длинного конца text, с которого может начинаться сообщение о лимите."""
+    for length in range(min(len(text), LIMIT_SCAN_OVERLAP), 0, -1):
+        if BLACKBOX_LIMIT_MSG.startswith(text[-length:]):
+            return length
+    return 0
+
+
+async def _provider_stream(provider, messages: list, model: str):
+    """Текстовые куски ответа одного провайдера."""
+    import g4f
+
+    tail = ""
+    async for chunk in g4f.ChatCompletion.create_async(
+            model=model,
+            messages=messages,
+            provider=provider,
+            headers=HEADERS,
+            timeout=10,
+            stream=True
+    ):
+        logger.debug(f"📦 Получен chunk: {chunk} (тип: {type(chunk)})")
+        if isinstance(chunk, str):
+            content = chunk
+        elif hasattr(chunk, 'content') and chunk.content:
+            content = chunk.content
+        else:
+            continue
+        # Проверка лимита Blackbox: сообщение может прийти разрезанным на куски, поэтому
+        # конец, похожий на его начало, придерживается до следующего куска (обычно он пуст)
+        window = tail + content
+        if BLACKBOX_LIMIT_MSG in window:
+            raise ProviderLimitError(BLACKBOX_LIMIT_MSG)
+        split = len(window) - _limit_prefix_length(window)
+        ready, tail = window[:split], window[split:]
+        if ready:
+            yield ready
+    if tail:
+        yield tail
+
+
+async def _open_stream(provider, messages: list, model: str):
+    """Запускает поток провайдера и ждёт первый кусок ответа."""
+    started = time.monotonic()
+    stream = _provider_stream(provider, messages, model)
+    try:
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        raise Exception("пустой ответ")
+    except BaseException:
+        await stream.aclose()
+        raise
+    latency = time.monotonic() - started
+    provider_router.record_success(model, provider, latency)
+    STREAM_FIRST_CHUNK_SECONDS.observe(latency, model=model, provider=provider_name(provider))
+    return provider, stream, first_chunk
+
+
+def _record_failure(model: str, provider, error: BaseException):
+    if isinstance(error, ProviderLimitError) or "429" in str(error) or "rate limit" in str(error).lower():
+        provider_router.record_rate_limit(model, provider)
+    else:
+        provider_router.record_error(model, provider)
+    STREAM_ERRORS.inc(model=model, provider=provider_name(provider))
+    logger.error(f"❌ Ошибка в {provider_name(provider)}: {str(error)}")
+
+
+async def _race(providers: list, messages: list, model: str, hedge_delay: float = None):
+    """
+    Возвращает первого провайдера, приславшего токен.
+
+    Провайдеры запускаются по одному: следующий добавляется, если предыдущие упали
+    или молчат дольше hedge_delay секунд. Остальные запросы отменяются.
+    """
+    waiting = list(providers)
+    tasks = {}
+
+    def launch():
+        provider = waiting.pop(0)
+        tasks[asyncio.create_task(_open_stream(provider, messages, model))] = provider
+
+    launch()
+    try:
+        while tasks:
+            timeout = hedge_delay if waiting else None
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch()
+                continue
+            winner = None
+            for task in done:
+                provider = tasks.pop(task)
+                error = task.exception()
+                if error is not None:
+                    _record_failure(model, provider, error)
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    # Второй успешный поток закроется вместе с остальными в finally
+                    tasks[task] = provider
+            if winner is not None:
+                return winner
+            if not tasks and waiting:
+                launch()
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                _, stream, _ = await task
+                await stream.aclose()
+            except asyncio.CancelledError:
+                # Отмена самого вызывающего не должна теряться, пока закрываются проигравшие
+                if asyncio.current_task().cancelling():
+                    raise
+            except Exception:
+                pass
+
+
+async def generate_gpt_stream(messages: list, model: str, queue: asyncio.Queue, providers: list = None):
     """Генерация ответа в потоке с использованием g4f."""
+    started = time.monotonic()
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Referer': 'https://www.google.com/',
-            'Origin': 'https://www.google.com/'
-        }
-
-        for provider in providers:
+        candidates = provider_router.rank(model, resolve_providers(providers))
+        while candidates:
+            batch = candidates[:1]
+            if HEDGE_REQUESTS and len(candidates) > 1 and provider_router.is_available(model, candidates[1]):
+                batch = candidates[:2]
+            candidates = candidates[len(batch):]
+            hedge_delay = max(HEDGE_MIN_DELAY, provider_router.expected_latency(model, batch[0]))
+            winner = await _race(batch, messages, model, hedge_delay)
+            if winner is None:
+                continue
+
+            provider, stream, first_chunk = winner
             try:
-                full_response = ""
-                async for chunk in g4f.ChatCompletion.create_async(
-                        model=model,
-                        messages=messages,
-                        headers=headers,
-                        timeout=10,
-                        stream=True
-                ):
-                    logger.debug(f"📦 Получен chunk: {chunk} (тип: {type(chunk)})")
-                    
-                    # Обработка текстовых чанков
-                    if isinstance(chunk, str):
-                        # Проверка лимита Blackbox
-                        if BLACKBOX_LIMIT_MSG in chunk:
-                            await queue.put(Exception("⚠️ Произошла ошибка при генерации ответа, попробуйте позже\nИли выберите другую модель"))
-                            return
-                        full_response += chunk
+                with span("stream", model=model, provider=provider_name(provider)):
+                    await queue.put(first_chunk)
+                    async for chunk in stream:
                         await queue.put(chunk)
-                    
-                    # Обработка объектов с атрибутом content
-                    elif hasattr(chunk, 'content') and chunk.content:
-                        content = chunk.content
-                        # Проверка лимита Blackbox
-                        if BLACKBOX_LIMIT_MSG in content:
-                            await queue.put(Exception("⚠️ Произошла ошибка при генерации ответа, попробуйте позже\nИли выберите другую модель"))
-                            return
-                        full_response += content
-                        await queue.put(content)
-                    
-                
-                # Финальная проверка лимита
-                if BLACKBOX_LIMIT_MSG in full_response:
-                    await queue.put(Exception("⚠️ Произошла ошибка при генерации ответа, попробуйте позже\nИли выберите другую модель"))
-                    return
-                
-                if full_response.strip():
-                    await queue.put(None)
-                return
-                
             except Exception as e:
-                logger.error(f"❌ Ошибка в {provider.__name__}: {str(e)}")
-                continue
-        
+                # Часть ответа уже отправлена, переключаться на другого провайдера поздно
+                _record_failure(model, provider, e)
+                await queue.put(Exception(LIMIT_ERROR_TEXT))
+                return
+            finally:
+                await stream.aclose()
+            STREAM_TOTAL_SECONDS.observe(time.monotonic() - started, model=model, provider=provider_name(provider))
+            await queue.put(None)
+            return
+
         await queue.put(Exception("⚠️ Все провайдеры недоступны. Попробуйте позже."))
-    
+
     except Exception as e:
         logger.error(f"❌ Общая ошибка генерации: {str(e)}")
         await queue.put(e)
 
+async def _stop_producer(task: asyncio.Task):
+    """Отменяет генерацию, которую больше никто не читает, вместе с её HTTP-потоком."""
+    if task is None or task.done():
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+    except Exception:
+        pass
+    logger.info("⏹ Генерация ответа остановлена")
+
+
 async def process_user_message(message: Message, model: str, history: list, save_message_func):
     """
     Обработка пользовательского сообщения с учетом истории диалога.
@@ -78,39 +218,35 @@ async def process_user_message(message: Message, model: str, history: list, save
     user_message = message.text
     await save_message_func(message.from_user.id, "user", user_message)
 
-    messages = [{"role": "system", "content": "Ты отвечаешь в телеграмме, используй форматирование как в телеграмме"}]
-    for msg_type, content in history:
-        role = "user" if msg_type == "user" else "assistant"
-        messages.append({"role": role, "content": content})
-    messages.append({"role": "user", "content": user_message})
+    # История укладывается в бюджет токенов модели, старые реплики сжимаются
+    messages, tokens = build_messages(model, history, user_message)
+    CONTEXT_TOKENS.observe(tokens, model=model)
 
     response_message = await message.answer(f"⏳ Обработка запроса... (Модель: {model})")
-    response_text = ""
-    last_update_time = 0
-    update_interval = 0.3
-
-    async def safe_edit(text: str):
-        nonlocal last_update_time
-        try:
-            await response_message.edit_text(text[:4096], parse_mode='Markdown')
-            last_update_time = time.time()
-        except TelegramRetryAfter as e:
-            logger.warning(f"⏳ Превышен лимит Telegram, ждем {e.retry_after} сек.")
-            await asyncio.sleep(e.retry_after)
-            await safe_edit(text)
-        except Exception as e:
-            logger.error(f"❌ Ошибка редактирования: {str(e)}")
+    renderer = StreamRenderer(response_message)
+
+    # Одинаковые вопросы без истории отвечаются из кэша через тот же потоковый путь
+    cache_key = None
+    cached = None
+    if response_cache.enabled_for(history):
+        cache_key = response_cache.key(model, user_message, history)
+        cached = await response_cache.get(cache_key)
 
+    producer = None
     try:
-        queue = asyncio.Queue()
-        asyncio.create_task(generate_gpt_stream(messages, model, queue, [Provider.Blackbox]))
+        # Ограниченная очередь: если Telegram не успевает, генерация ждёт, а не копит ответ в памяти
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        if cached:
+            producer = asyncio.create_task(replay_cached(cached, queue))
+        else:
+            producer = asyncio.create_task(generate_gpt_stream(messages, model, queue))
 
         while True:
             try:
-                chunk = await asyncio.wait_for(queue.get(), timeout=35.0)
+                chunk = await asyncio.wait_for(queue.get(), timeout=STREAM_CHUNK_TIMEOUT)
             except asyncio.TimeoutError:
                 logger.error("⚠️ Таймаут ожидания ответа")
-                await safe_edit("⌛ Превышено время ожидания ответа")
+                await edit_scheduler.flush(renderer.tail, "⌛ Превышено время ожидания ответа")
                 return
 
             if chunk is None:
@@ -118,13 +254,18 @@ async def process_user_message(message: Message, model: str, history: list, save
             if isinstance(chunk, Exception):
                 raise chunk
 
-            response_text += str(chunk)
-            if (time.time() - last_update_time) > update_interval:
-                await safe_edit(response_text[:4096])
+            # Планировщик сам объединяет частые правки и соблюдает лимиты Telegram
+            await renderer.append(str(chunk))
 
+        response_text = renderer.text
         if response_text:
-            await safe_edit(response_text[:4096])
+            await renderer.finish()
             await save_message_func(message.from_user.id, "bot", response_text)
+            if cache_key and not cached:
+                await response_cache.set(cache_key, response_text)
     except Exception as e:
         logger.error(f"❌ Ошибка генерации: {str(e)}")
-        await safe_edit("⚠️ Произошла ошибка при генерации ответа, попробуйте позже\nИли выберите другую модель")
+        await edit_scheduler.flush(renderer.tail, LIMIT_ERROR_TEXT)
+    finally:
+        await _stop_producer(producer)
+        renderer.forget()
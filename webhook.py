@@ -0,0 +1,129 @@
+"""
+Запуск бота в режиме webhook вместо long polling.
+
+Несколько процессов-воркеров слушают один порт (SO_REUSEPORT), поэтому экземпляры
+можно ставить за балансировщик. Telegram подписывает запросы секретным токеном.
+Метрики воркера с номером i доступны на порту METRICS_PORT + i. Модель и история
+читаются из общей базы без кэша процесса, а сжатие базы и сохранение оценок провайдеров
+выполняет только воркер 0.
+
+Запуск: WEBHOOK_URL=https://example.com WEBHOOK_SECRET=<случайная строка> python webhook.py
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Telegram будет присылать обновления
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# Отвечать Telegram сразу и обрабатывать обновление в фоне (0 — ждать обработчик, удобно для нагрузочных тестов)
+WEBHOOK_HANDLE_IN_BACKGROUND = os.getenv("WEBHOOK_HANDLE_IN_BACKGROUND", "1") != "0"
+# Сколько секунд ждать завершения начатых генераций при остановке
+SHUTDOWN_TIMEOUT = 60.0
+
+
+def create_app() -> web.Application:
+    """aiohttp-приложение с обработчиком webhook и хуками жизненного цикла бота."""
+    from main import bot, dp, on_startup, on_shutdown
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=WEBHOOK_HANDLE_IN_BACKGROUND,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def run_worker(index: int = 0):
+    """Один процесс-воркер: принимает обновления до сигнала остановки."""
+    if WEBHOOK_WORKERS > 1:
+        # Общий файл журнала воркеры восстанавливали бы и сжимали наперегонки
+        from journal import job_journal, worker_journal_path
+        from cache import CachedStorage
+        import main
+        import metrics
+
+        job_journal.path = worker_journal_path(index)
+        # Смену модели и очистку истории в другом воркере кэш процесса не увидел бы до истечения TTL,
+        # поэтому кэш без записей: каждое чтение идёт в общую базу
+        main.db = CachedStorage(main.db.backend, maxsize=0)
+        # Общие bot.db и provider_scores.json обслуживает и переписывает только один воркер
+        main.RUN_MAINTENANCE = index == 0
+        # Каждый воркер отдаёт свои метрики на METRICS_PORT + номер воркера
+        if metrics.METRICS_PORT:
+            metrics.METRICS_PORT += index
+    web.run_app(
+        create_app(),
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        reuse_port=WEBHOOK_WORKERS > 1,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+        print=None,
+    )
+
+
+async def register_webhook():
+    from main import bot
+
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=False,
+    )
+    await bot.session.close()
+    logger.info(f"✅ Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+
+def main():
+    if not WEBHOOK_SECRET:
+        # Без секрета любой, кто знает адрес, может прислать поддельное обновление
+        if WEBHOOK_URL:
+            logger.error("❌ WEBHOOK_SECRET не задан: webhook принимал бы обновления от кого угодно")
+            sys.exit(1)
+        logger.warning("⚠️ WEBHOOK_SECRET не задан: подпись обновлений от Telegram не проверяется")
+
+    if WEBHOOK_URL:
+        asyncio.run(register_webhook())
+
+    if WEBHOOK_WORKERS <= 1:
+        run_worker()
+        return
+
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(i,), name=f"webhook-{i}") for i in range(WEBHOOK_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        # Воркеры сами дожидаются начатых генераций в on_shutdown
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()